@@ -0,0 +1,370 @@
+#!/usr/bin/env python3
+# EW11 수집 데이터 오프라인 분석 도구
+#   - raw binary (ew11/recv payload 또는 socket 수신 데이터를 그대로 저장한 파일) 또는 hex 텍스트 파일 지원
+#     (hex 텍스트는 공백으로 구분된 토큰 중 짝수 길이의 hex 토큰만 사용하므로 EW11_LOG 로그도 그대로 분석 가능)
+#   - 0xF7 패킷 시작 위치 탐색과 XOR/ADD Checksum 검증을 NumPy로 한번에 처리
+#   - ezville.py와 같은 장치 정보 (RS485_DEVICE, STATE_HEADER, ACK_HEADER) 사용
+#
+# 사용법: python analyze_capture.py capture.bin [--hex] [--baud 9600] [--json] [--max-events 50]
+#         python analyze_capture.py --check 3000 (가상 수집 데이터로 EW11_process와 같은 순차 분리 결과와 비교)
+
+import argparse
+import json
+import random
+import sys
+
+import numpy as np
+
+from ezville import checksum, verify_checksum, RS485_DEVICE, STATE_HEADER, ACK_HEADER
+
+
+# 한번에 처리할 최대 패킷 수 (메모리 사용량 제한)
+CHUNK_SIZE = 1 << 20
+
+# 장치 ID별 이름, State/ACK 명령 코드
+DEVICE_NAME = {int(prop['state']['id'], 16): device for device, prop in RS485_DEVICE.items() if 'state' in prop}
+STATE_CMD = {int(id, 16): int(cmd, 16) for id, (device, cmd) in STATE_HEADER.items()}
+ACK_CMD = {int(id, 16): int(cmd, 16) for id, (device, cmd) in ACK_HEADER.items()}
+
+
+# 수집 파일을 byte 배열로 읽기
+#   hex 텍스트는 공백으로 구분된 토큰 중 16진수 문자로만 된 짝수 길이 토큰만 변환
+#   (로그의 날짜, "receved:" 같은 단어가 섞여도 16진수 두 자리 묶음이 어긋나지 않도록 함)
+def load_capture(path, hex_text=False):
+    data = np.fromfile(path, dtype=np.uint8)
+
+    if not hex_text:
+        return data
+
+    return parse_hex(data)
+
+
+def parse_hex(data):
+    lookup = np.full(256, -1, dtype=np.int16)
+    for i, c in enumerate(b'0123456789ABCDEF'):
+        lookup[c] = i
+    for i, c in enumerate(b'abcdef'):
+        lookup[c] = 10 + i
+
+    space = np.zeros(256, dtype=bool)
+    space[list(b' \t\r\n\v\f')] = True
+
+    # 공백이 아닌 문자마다 속한 토큰 번호를 붙여서 토큰 단위로 판단
+    is_space = space[data]
+    tokens = np.cumsum(is_space)[~is_space]
+    digits = lookup[data[~is_space]]
+
+    if len(tokens) == 0:
+        return np.zeros(0, dtype=np.uint8)
+
+    bad = np.bincount(tokens) % 2 == 1
+    bad[tokens[digits < 0]] = True
+
+    digits = digits[~bad[tokens]]
+
+    return ((digits[0::2] << 4) | digits[1::2]).astype(np.uint8)
+
+
+# 0xF7 위치를 모두 찾아 패킷 후보의 시작, 길이, 끝 위치와 Checksum 결과 반환
+def find_frames(data):
+    starts = np.flatnonzero(data == 0xF7)
+    starts = starts[starts + 5 <= len(data)]
+
+    lengths = data[starts + 4].astype(np.int64)
+    ends = starts + 5 + lengths + 2
+
+    fits = ends <= len(data)
+    starts, lengths, ends = starts[fits], lengths[fits], ends[fits]
+
+    valid = np.zeros(len(starts), dtype=bool)
+
+    # 같은 데이터 길이의 패킷끼리 2차원 배열로 모아서 Checksum 계산
+    for length in np.unique(lengths):
+        selected = np.flatnonzero(lengths == length)
+        offsets = np.arange(5 + length)
+
+        for chunk in range(0, len(selected), CHUNK_SIZE):
+            sel = selected[chunk:chunk + CHUNK_SIZE]
+            body = data[starts[sel, None] + offsets]
+
+            xor = np.bitwise_xor.reduce(body, axis=1)
+            add = ((body.sum(axis=1, dtype=np.int64) + xor) & 0xFF).astype(np.uint8)
+
+            valid[sel] = (data[starts[sel] + 5 + length] == xor) & (data[starts[sel] + 6 + length] == add)
+
+    return starts, lengths, ends, valid
+
+
+# Valid 패킷 내부 데이터에서 우연히 Checksum이 맞은 패킷 제거
+#   마지막으로 인정된 패킷의 끝 위치보다 앞에서 시작하면 제외 (EW11_process처럼 패킷 단위로 건너뛰는 것과 같은 효과)
+#   제외된 패킷의 끝 위치는 반영하지 않아야 하므로 순차 처리 (Valid 패킷 수는 실제 패킷 수와 비슷)
+def remove_overlaps(starts, ends):
+    keep = np.zeros(len(starts), dtype=bool)
+    last_end = -1
+
+    for i, (start, end) in enumerate(zip(starts.tolist(), ends.tolist())):
+        if start >= last_end:
+            keep[i] = True
+            last_end = end
+
+    return keep
+
+
+# 장치 ID, 명령 코드별 패킷 수와 Checksum 오류율 집계
+def summarize(data, starts, ends, valid, frames):
+    frame_starts = starts[frames]
+    frame_ends = ends[frames]
+
+    ids = data[frame_starts + 1].astype(np.int64)
+    cmds = data[frame_starts + 3].astype(np.int64)
+
+    # 인정된 패킷 내부가 아닌 위치에서 알려진 장치 ID로 시작하는데 Checksum이 틀린 경우를 오류로 판단
+    if len(frame_starts):
+        inside = np.searchsorted(frame_starts, starts, side='right') - 1
+        inside = (inside >= 0) & (starts < frame_ends[np.maximum(inside, 0)])
+    else:
+        inside = np.zeros(len(starts), dtype=bool)
+    known = np.isin(data[starts + 1], list(DEVICE_NAME))
+    errors = starts[~valid & ~inside & known]
+
+    error_ids, error_counts = np.unique(data[errors + 1], return_counts=True)
+    error_count = dict(zip(error_ids.tolist(), error_counts.tolist()))
+
+    keys, counts = np.unique((ids << 8) | cmds, return_counts=True)
+
+    devices = {}
+    for key, count in zip(keys.tolist(), counts.tolist()):
+        id, cmd = key >> 8, key & 0xFF
+
+        if STATE_CMD.get(id) == cmd:
+            kind = 'state'
+        elif ACK_CMD.get(id) == cmd:
+            kind = 'ack'
+        else:
+            kind = 'other'
+
+        device = devices.setdefault('{:02X}'.format(id), {'name': DEVICE_NAME.get(id, 'unknown'), 'frames': 0, 'errors': error_count.get(id, 0), 'commands': {}})
+        device['frames'] += count
+        device['commands']['{:02X}'.format(cmd)] = {'kind': kind, 'frames': count}
+
+    # 정상 패킷 없이 오류만 있는 장치도 포함
+    for id, count in error_count.items():
+        devices.setdefault('{:02X}'.format(id), {'name': DEVICE_NAME.get(id, 'unknown'), 'frames': 0, 'errors': count, 'commands': {}})
+
+    for device in devices.values():
+        total = device['frames'] + device['errors']
+        device['error_rate'] = device['errors'] / total if total else 0.0
+
+    return devices
+
+
+# State/ACK 패킷에서 장치 그룹별로 데이터가 바뀐 시점만 추출
+#   수백 MB 수집 파일도 빠르게 처리하도록 (패킷 위치, 장치/그룹 ID, 데이터 길이) NumPy 배열로 반환
+def state_timeline(data, starts, lengths, frames):
+    frame_starts = starts[frames]
+    frame_lengths = lengths[frames]
+
+    ids = data[frame_starts + 1]
+    cmds = data[frame_starts + 3]
+    is_state = np.zeros(len(frame_starts), dtype=bool)
+    for id, cmd in list(STATE_CMD.items()) + list(ACK_CMD.items()):
+        is_state |= (ids == id) & (cmds == cmd)
+
+    offsets, keys, sizes = [], [], []
+
+    for length in np.unique(frame_lengths[is_state]):
+        selected = np.flatnonzero(is_state & (frame_lengths == length))
+        positions = frame_starts[selected]
+
+        # 장치 ID, 그룹 ID 순서로 안정 정렬 후 같은 그룹 안에서 직전 패킷과 비교
+        group = (data[positions + 1].astype(np.int64) << 8) | data[positions + 2]
+        order = np.lexsort((positions, group))
+        positions, group = positions[order], group[order]
+
+        payload = data[positions[:, None] + 5 + np.arange(length)]
+
+        changed = np.ones(len(positions), dtype=bool)
+        if len(positions) > 1:
+            changed[1:] = (group[1:] != group[:-1]) | np.any(payload[1:] != payload[:-1], axis=1)
+
+        offsets.append(positions[changed])
+        keys.append(group[changed])
+        sizes.append(np.full(np.count_nonzero(changed), length, dtype=np.int64))
+
+    if not offsets:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    offsets, keys, sizes = np.concatenate(offsets), np.concatenate(keys), np.concatenate(sizes)
+    order = np.argsort(offsets, kind='stable')
+
+    return offsets[order], keys[order], sizes[order]
+
+
+# 출력할 상태 변경만 dict로 변환
+def timeline_events(data, offsets, keys, sizes, bytes_per_second=None):
+    events = []
+
+    for position, key, length in zip(offsets.tolist(), keys.tolist(), sizes.tolist()):
+        event = {
+            'offset': position,
+            'device': DEVICE_NAME.get(key >> 8, 'unknown'),
+            'group': '{:02X}'.format(key & 0xFF),
+            'payload': data[position + 5:position + 5 + length].tobytes().hex().upper()
+        }
+        if bytes_per_second:
+            event['time'] = round(position / bytes_per_second, 3)
+        events.append(event)
+
+    return events
+
+
+# 인정된 패킷의 시작 위치 (main과 같은 처리)
+def accepted_frames(data):
+    starts, lengths, ends, valid = find_frames(data)
+
+    frames = np.flatnonzero(valid)
+    frames = frames[remove_overlaps(starts[frames], ends[frames])]
+
+    return starts[frames]
+
+
+# EW11_process와 같은 순차 패킷 분리 (검증용 기준)
+#   파일 끝을 넘는 패킷은 이어서 받을 데이터가 없으므로 RESIDUE에 보관하지 않고 Checksum 오류와 같이 건너뜀
+def reference_frames(data):
+    k = 0
+    result = []
+
+    while True:
+        k = data.find(0xF7, k)
+        if k < 0 or k + 5 > len(data):
+            break
+
+        packet_length = 5 + data[k + 4] + 2
+        if k + packet_length > len(data) or not verify_checksum(data[k:k + packet_length]):
+            k += 1
+            continue
+
+        result.append(k)
+        k += packet_length
+
+    return result
+
+
+# 가상 수집 데이터 생성 (0xF7이 섞인 데이터, 잡음, Checksum 오류 패킷, 패킷 내부에서 우연히 Checksum이 맞는 가짜 패킷 포함)
+def synthetic_capture(rng, count):
+    headers = [(int(prop['state']['id'], 16), int(prop['state']['cmd'], 16)) for prop in RS485_DEVICE.values() if 'state' in prop]
+
+    def header(length):
+        id, cmd = rng.choice(headers)
+        return bytes([0xF7, id, rng.randrange(256), cmd, length])
+
+    def frame(data, head=None):
+        head = head or header(len(data))
+        return bytearray.fromhex(checksum((head + bytes(data) + b'\x00\x00').hex()))
+
+    def payload(length):
+        return [0xF7 if rng.random() < 0.1 else rng.randrange(256) for _ in range(length)]
+
+    capture = bytearray()
+
+    for _ in range(count):
+        kind = rng.random()
+
+        if kind < 0.1:
+            capture += bytes(payload(rng.randrange(1, 8)))
+        elif kind < 0.2:
+            packet = frame(payload(rng.randrange(1, 16)))
+            packet[rng.randrange(len(packet))] ^= 1 << rng.randrange(8)
+            capture += packet
+        elif kind < 0.3:
+            # 앞 패킷 A 내부에 시작해서 다음 패킷 C의 데이터에 Checksum이 있는 가짜 패킷 B
+            first = payload(rng.randrange(6, 16))
+            i = rng.randrange(len(first) - 4)
+            first[i] = 0xF7
+
+            b_start = len(capture) + 5 + i
+            c_start = len(capture) + len(first) + 7
+            second = payload(rng.randrange(4, 16))
+            j = rng.randrange(len(second) - 1)
+
+            first[i + 4] = c_start + j - b_start
+            capture += frame(first)
+
+            head = header(len(second))
+            body = capture[b_start:] + head + bytes(second[:j])
+            xor = 0
+            for b in body:
+                xor ^= b
+            second[j], second[j + 1] = xor, (sum(body) + xor) & 0xFF
+
+            capture += frame(second, head)
+        else:
+            capture += frame(payload(rng.randrange(1, 16)))
+
+    return bytes(capture)
+
+
+# 가상 수집 데이터로 분석 결과와 순차 패킷 분리 결과 비교
+def check(count, seed=0):
+    rng = random.Random(seed)
+    failed = 0
+
+    for _ in range(count):
+        capture = synthetic_capture(rng, 200)
+        expected = reference_frames(capture)
+        result = accepted_frames(np.frombuffer(capture, dtype=np.uint8)).tolist()
+
+        if result != expected:
+            failed += 1
+
+    print('[INFO] 가상 수집 데이터 {}개 중 {}개 불일치'.format(count, failed))
+
+    return failed == 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='EW11 수집 데이터 오프라인 분석')
+    parser.add_argument('capture', nargs='?', help='수집 파일 (raw binary 또는 --hex 사용시 hex 텍스트)')
+    parser.add_argument('--hex', action='store_true', help='hex 텍스트 파일로 읽기')
+    parser.add_argument('--baud', type=int, default=None, help='통신 속도 (지정시 byte 위치로 상대 시간 추정, 8N1 기준)')
+    parser.add_argument('--json', action='store_true', help='전체 결과를 JSON으로 출력')
+    parser.add_argument('--max-events', type=int, default=50, help='텍스트 출력시 표시할 상태 변경 수')
+    parser.add_argument('--check', type=int, metavar='N', help='수집 파일 대신 가상 수집 데이터 N개로 패킷 분리 결과 검증')
+    args = parser.parse_args(argv)
+
+    if args.check:
+        sys.exit(0 if check(args.check) else 1)
+    if args.capture is None:
+        parser.error('수집 파일을 지정해야 합니다')
+
+    data = load_capture(args.capture, args.hex)
+
+    starts, lengths, ends, valid = find_frames(data)
+
+    # Valid 패킷 중 겹치지 않는 패킷만 최종 인정
+    frames = np.flatnonzero(valid)
+    frames = frames[remove_overlaps(starts[frames], ends[frames])]
+
+    devices = summarize(data, starts, ends, valid, frames)
+    offsets, keys, sizes = state_timeline(data, starts, lengths, frames)
+    bytes_per_second = args.baud / 10 if args.baud else None
+
+    if args.json:
+        events = timeline_events(data, offsets, keys, sizes, bytes_per_second)
+        json.dump({'bytes': int(len(data)), 'frames': int(len(frames)), 'devices': devices, 'timeline': events}, sys.stdout, indent=2)
+        print()
+        return
+
+    print('[INFO] {} bytes, {} packets'.format(len(data), len(frames)))
+    for id, device in sorted(devices.items()):
+        print('[INFO] {} ({}): {} packets, {} errors ({:.2%})'.format(id, device['name'], device['frames'], device['errors'], device['error_rate']))
+        for cmd, info in sorted(device['commands'].items()):
+            print('         CMD {} ({}): {}'.format(cmd, info['kind'], info['frames']))
+
+    print('[INFO] 상태 변경 {}건'.format(len(offsets)))
+    for event in timeline_events(data, offsets[:args.max_events], keys[:args.max_events], sizes[:args.max_events], bytes_per_second):
+        print('  {:>12} {:<10} {} {}'.format(event.get('time', event['offset']), event['device'], event['group'], event['payload']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# ezville_loop 패킷 처리 메모리/속도 측정 도구
+#   - harness.py의 가상 시간 loop에 조명, 난방, 대기전력 State 패킷을 일정 간격으로 넣어서 처리
+#   - tracemalloc으로 ezville.py가 유지하는 메모리와 패킷 묶음(tick)별 순간 할당량, 최대 RSS 측정
+#
+# 사용법: python benchmark.py [--rooms 6] [--ticks 2000] [--interval 0.25] [--change 0.1]
+
+import argparse
+import collections
+import random
+import resource
+import tracemalloc
+
+import ezville
+from ezville import checksum, RS485_DEVICE, EW11_TOPIC
+from harness import Harness
+
+
+# 방 개수만큼 조명 (방당 3개), 난방, 대기전력 (방당 2개) State 패킷 생성
+class FrameSource:
+    def __init__(self, rooms, change):
+        self.rooms = rooms
+        self.change = change
+        self.lights = {room: [0, 0, 0] for room in range(1, rooms + 1)}
+        self.temps = {room: [22, 20] for room in range(1, rooms + 1)}
+        self.plugs = {room: [(0x11, 5), (0x10, 4096)] for room in range(1, rooms + 1)}
+
+    # change 비율만큼 값이 바뀐 상태로 다음 패킷 묶음 생성
+    def tick(self):
+        for room in range(1, self.rooms + 1):
+            if random.random() < self.change:
+                light = random.randrange(3)
+                self.lights[room][light] ^= 1
+            if random.random() < self.change:
+                self.temps[room][1] = random.randint(15, 25)
+            if random.random() < self.change:
+                plug = random.randrange(2)
+                state, watt = self.plugs[room][plug]
+                self.plugs[room][plug] = (state, random.randint(0, 5000))
+
+        frames = []
+        for room in range(1, self.rooms + 1):
+            data = '00' + ''.join('{:02X}'.format(state) for state in self.lights[room])
+            frames.append(self.frame('light', '1' + str(room), data))
+
+            data = '02' + ''.join('{:02X}{:04X}'.format(state, watt) for state, watt in self.plugs[room])
+            frames.append(self.frame('plug', '1' + str(room), data))
+
+        # 난방은 전체 방을 한 패킷으로 전달
+        data = '00' + '{:02X}'.format((1 << self.rooms) - 1) + '0000' + ''.join('{:02X}{:02X}'.format(*self.temps[room]) for room in range(1, self.rooms + 1))
+        frames.append(self.frame('thermostat', '1F', data))
+
+        return b''.join(bytes.fromhex(frame) for frame in frames), len(frames)
+
+    def frame(self, device, group, data):
+        state = RS485_DEVICE[device]['state']
+        return checksum('F7' + state['id'] + group + state['cmd'] + '{:02X}'.format(len(data) // 2) + data + '0000')
+
+
+def run(rooms, ticks, change, interval, trace):
+    random.seed(0)
+    source = FrameSource(rooms, change)
+
+    harness = Harness({'force_update_mode': False, 'plug_publish_interval': 60}, rooms={})
+    stats = {'frames': 0, 'published': 0, 'transient': []}
+
+    # Publish 및 로그 기록이 메모리 측정에 포함되지 않도록 Publish는 개수만 집계
+    harness.mqtt.published = collections.deque(maxlen=1)
+    harness.logs = collections.deque(maxlen=1)
+    publish = harness.mqtt.publish
+
+    def count_publish(topic, payload=None, qos=0, retain=False):
+        stats['published'] += 1
+        publish(topic, payload, qos, retain)
+
+    harness.mqtt.publish = count_publish
+
+    def feed():
+        if trace:
+            current, peak = tracemalloc.get_traced_memory()
+            stats['transient'].append(peak - current)
+            tracemalloc.reset_peak()
+
+        payload, count = source.tick()
+        stats['frames'] += count
+        harness.mqtt.deliver(EW11_TOPIC + '/recv', payload)
+
+    # ezville_loop가 끝나면 State 저장 공간도 해제되므로 실행 중에 측정
+    def measure():
+        snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(True, ezville.__file__, all_frames=True)])
+        stats['retained'] = sum(stat.size for stat in snapshot.statistics('filename'))
+        stats['blocks'] = sum(stat.count for stat in snapshot.statistics('filename'))
+
+    for i in range(ticks):
+        harness.at(1.0 + i * interval, feed)
+
+    if trace:
+        harness.at(1.0 + ticks * interval + 0.5, measure)
+        tracemalloc.start(25)
+
+    harness.run(1.0 + ticks * interval + 1.0)
+
+    if trace:
+        tracemalloc.stop()
+
+    stats['elapsed'] = harness.elapsed
+
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='ezville_loop 패킷 처리 메모리/속도 측정')
+    parser.add_argument('--rooms', type=int, default=6, help='방 개수 (최대 8)')
+    parser.add_argument('--ticks', type=int, default=2000, help='패킷 묶음 수')
+    parser.add_argument('--interval', type=float, default=0.25, help='패킷 묶음 간격 (가상 시간 초)')
+    parser.add_argument('--change', type=float, default=0.1, help='패킷 묶음마다 방별로 값이 바뀔 확률')
+    args = parser.parse_args(argv)
+
+    # 속도는 tracemalloc 없이, 메모리는 tracemalloc으로 따로 측정
+    timing = run(args.rooms, args.ticks, args.change, args.interval, False)
+    memory = run(args.rooms, args.ticks, args.change, args.interval, True)
+
+    transient = sorted(memory['transient'][1:])
+
+    print('[INFO] {} packets, {} publishes'.format(timing['frames'], timing['published']))
+    print('[INFO] 처리 시간: {:.1f} us/packet'.format(timing['elapsed'] / timing['frames'] * 1e6))
+    print('[INFO] ezville.py 유지 메모리: {} bytes ({} blocks)'.format(memory['retained'], memory['blocks']))
+    print('[INFO] tick별 순간 할당량 (중앙값/최대): {} / {} bytes ({:.0f} bytes/packet)'.format(
+        transient[len(transient) // 2], transient[-1], transient[len(transient) // 2] / (memory['frames'] / args.ticks)))
+    print('[INFO] 최대 RSS: {} KB'.format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+
+
+if __name__ == '__main__':
+    main()
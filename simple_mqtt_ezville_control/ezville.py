@@ -3,22 +3,30 @@ import json
 import time
 import asyncio
 import threading
-import telnetlib
 import socket
 import random
+import heapq
+import itertools
+import os
+import struct
+import mmap
+import bisect
 
 from threading import Thread
-from queue import Queue
+from queue import Queue, Full
+from collections import deque
 
 # DEVICE 별 패킷 정보
 RS485_DEVICE = {
     'light': {
         'state':    { 'id': '0E', 'cmd': '81' },
+        'query':    { 'id': '0E', 'cmd': '01', 'group': '1{}' },
 
         'power':    { 'id': '0E', 'cmd': '41', 'ack': 'C1' }
     },
     'thermostat': {
         'state':    { 'id': '36', 'cmd': '81' },
+        'query':    { 'id': '36', 'cmd': '01', 'group': '1F' },     # 전체 방 State를 한번에 회신
         
         'power':    { 'id': '36', 'cmd': '43', 'ack': 'C3' },
         'away':    { 'id': '36', 'cmd': '45', 'ack': 'C5' },
@@ -94,7 +102,17 @@ DISCOVERY_PAYLOAD = {
         '~': 'ezville/plug_{:0>2d}_{:0>2d}',
         'name': 'ezville_plug_{:0>2d}_{:0>2d}_powermeter',
         'stat_t': '~/current/state',
+        'json_attr_t': '~/current/attributes',
         'unit_of_meas': 'W'
+    },
+    {
+        '_intg': 'sensor',
+        '~': 'ezville/plug_{:0>2d}_{:0>2d}',
+        'name': 'ezville_plug_{:0>2d}_{:0>2d}_energy',
+        'stat_t': '~/energy/state',
+        'unit_of_meas': 'kWh',
+        'dev_cla': 'energy',
+        'stat_cla': 'total_increasing'
     } ],
     'gasvalve': [ {
         '_intg': 'switch',
@@ -131,9 +149,97 @@ DISCOVERY_PAYLOAD = {
         'name': 'ezville_batch-outing_{:0>2d}_{:0>2d}',
         'stat_t': '~/outing/state',
         'icon': 'mdi:home-circle'
+    } ],
+    'bridge': [ {
+        '_intg': 'sensor',
+        '~': 'ezville/bridge_{:0>2d}_{:0>2d}',
+        'name': 'ezville_bridge-mqtt-recovery_{:0>2d}_{:0>2d}',
+        'stat_t': '~/mqttRecovery/state',
+        'unit_of_meas': 's',
+        'icon': 'mdi:timer-refresh'
+    },
+    {
+        '_intg': 'sensor',
+        '~': 'ezville/bridge_{:0>2d}_{:0>2d}',
+        'name': 'ezville_bridge-ew11-recovery_{:0>2d}_{:0>2d}',
+        'stat_t': '~/ew11Recovery/state',
+        'unit_of_meas': 's',
+        'icon': 'mdi:timer-refresh'
+    },
+    {
+        '_intg': 'sensor',
+        '~': 'ezville/bridge_{:0>2d}_{:0>2d}',
+        'name': 'ezville_bridge-ha-recovery_{:0>2d}_{:0>2d}',
+        'stat_t': '~/haRecovery/state',
+        'unit_of_meas': 's',
+        'icon': 'mdi:timer-refresh'
+    },
+    {
+        '_intg': 'sensor',
+        '~': 'ezville/bridge_{:0>2d}_{:0>2d}',
+        'name': 'ezville_bridge-command-dropped_{:0>2d}_{:0>2d}',
+        'stat_t': '~/cmdDropped/state',
+        'icon': 'mdi:playlist-remove'
+    },
+    {
+        '_intg': 'sensor',
+        '~': 'ezville/bridge_{:0>2d}_{:0>2d}',
+        'name': 'ezville_bridge-bus-queue-hwm_{:0>2d}_{:0>2d}',
+        'stat_t': '~/busQueueHwm/state',
+        'icon': 'mdi:tray-full'
+    },
+    {
+        '_intg': 'sensor',
+        '~': 'ezville/bridge_{:0>2d}_{:0>2d}',
+        'name': 'ezville_bridge-command-queue-hwm_{:0>2d}_{:0>2d}',
+        'stat_t': '~/cmdQueueHwm/state',
+        'icon': 'mdi:tray-full'
+    },
+    {
+        '_intg': 'sensor',
+        '~': 'ezville/bridge_{:0>2d}_{:0>2d}',
+        'name': 'ezville_bridge-bus-shed_{:0>2d}_{:0>2d}',
+        'stat_t': '~/busShed/state',
+        'icon': 'mdi:tray-remove'
+    },
+    {
+        '_intg': 'sensor',
+        '~': 'ezville/bridge_{:0>2d}_{:0>2d}',
+        'name': 'ezville_bridge-command-overflow_{:0>2d}_{:0>2d}',
+        'stat_t': '~/cmdOverflow/state',
+        'icon': 'mdi:tray-remove'
+    },
+    {
+        '_intg': 'sensor',
+        '~': 'ezville/bridge_{:0>2d}_{:0>2d}',
+        'name': 'ezville_bridge-active-path_{:0>2d}_{:0>2d}',
+        'stat_t': '~/activePath/state',
+        'icon': 'mdi:swap-horizontal'
     } ]
 }
 
+# JSON State 모드에서 속성별 State Topic 대신 장치 State Topic과 함께 등록할 Template 항목
+#   light는 value_template 대신 state_value_template 사용
+JSON_STATE_TEMPLATE = {
+    'stat_t': 'val_tpl',
+    'mode_stat_t': 'mode_stat_tpl',
+    'temp_stat_t': 'temp_stat_tpl',
+    'curr_temp_t': 'curr_temp_tpl'
+}
+
+# Command 우선순위 (숫자가 작을수록 먼저 실행)
+COMMAND_PRIORITY = {
+    'safety': 0,
+    'interactive': 1,
+    'automation': 2
+}
+
+# 장치별 기본 Command 우선순위 (없으면 interactive)
+DEVICE_PRIORITY = {
+    'gasvalve': 'safety',
+    'batch': 'safety'
+}
+
 # STATE 확인용 Dictionary
 STATE_HEADER = {
     prop['state']['id']: (device, prop['state']['cmd'])
@@ -149,6 +255,22 @@ ACK_HEADER = {
             if 'ack' in code
 }
 
+# BYTE 패킷 확인용 Dictionary (장치 ID: (장치, 명령 코드))
+STATE_CODE = {int(id, 16): (device, int(cmd, 16)) for id, (device, cmd) in STATE_HEADER.items()}
+ACK_CODE = {int(id, 16): (device, int(cmd, 16)) for id, (device, cmd) in ACK_HEADER.items()}
+
+# 장치별 State 속성 (Device.values의 순서)
+DEVICE_PROPERTY = {
+    'light': ('power',),
+    'thermostat': ('power', 'setTemp', 'curTemp'),
+    'plug': ('power', 'auto', 'current', 'energy'),
+    'gasvalve': ('power',),
+    'batch': ('elevator-up', 'elevator-down', 'group', 'outing'),
+    'bridge': ('mqttRecovery', 'ew11Recovery', 'haRecovery', 'cmdDropped', 'busQueueHwm', 'cmdQueueHwm', 'busShed', 'cmdOverflow', 'activePath')
+}
+
+PROPERTY_INDEX = {device: {state: i for i, state in enumerate(props)} for device, props in DEVICE_PROPERTY.items()}
+
 # LOG 메시지
 def log(string):
     date = time.strftime('%Y-%m-%d %p %I:%M:%S', time.localtime(time.time()))
@@ -176,51 +298,408 @@ def checksum(input_hex):
     except:
         return None
 
+
+# 장치 상태 요구 패킷 생성 (명령 확인이 늦을 때 월패드 Polling을 기다리지 않고 바로 조회, PACKETS.md에 확인된 조명/난방만 지원)
+def state_query(device, rid):
+    query = RS485_DEVICE[device]['query']
+    return checksum('F7' + query['id'] + query['group'].format(rid) + query['cmd'] + '00' + '0000')
+
+
+# BYTE 패킷의 CHECKSUM 및 ADD 확인
+def verify_checksum(packet):
+    checksum = 0
+    for b in packet[:-2]:
+        checksum ^= b
+        
+    return packet[-2] == checksum and packet[-1] == (sum(packet[:-2]) + checksum) & 0xFF
+
+
+# 이전 패킷과 비교하여 값이 바뀐 BYTE 위치를 반환 (offset은 패킷 내 시작 BYTE 위치, 비교할 수 없으면 None)
+def diff_bytes(prev_data, input_data, offset=0):
+    if prev_data is None or len(prev_data) != len(input_data):
+        return None
+    
+    return {offset + i for i, (prev, cur) in enumerate(zip(prev_data, input_data)) if prev != cur}
+
+
+# 장치 하나의 State 저장 공간 (속성 값은 DEVICE_PROPERTY 순서의 list로 보관)
+class Device:
+    __slots__ = ('name', 'index', 'values', 'pending', 'discovered')
+    
+    def __init__(self, device, rid, sid):
+        self.name = '{}_{:0>2d}_{:0>2d}'.format(device, rid, sid)
+        self.index = PROPERTY_INDEX[device]
+        self.values = [None] * len(self.index)
+        # 확인 대기 중인 목표값 (속성: 값, 없으면 None)
+        self.pending = None
+        self.discovered = False
+        
+    def __repr__(self):
+        return self.name
+        
+    def get(self, state):
+        return self.values[self.index[state]]
+        
+    def set(self, state, value):
+        self.values[self.index[state]] = value
+
+
+# asyncio 기반 Telnet Client (EW11 관리 접속용, 접속/수신에 Timeout 적용)
+class EW11Telnet:
+    IAC = 255
+    DONT = 254
+    DO = 253
+    WONT = 252
+    WILL = 251
+    SB = 250
+    SE = 240
+    
+    def __init__(self, host, port=23, timeout=10):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.reader = None
+        self.writer = None
+        self.buffer = b''
+        self.pending = b''
+        
+    async def connect(self):
+        self.reader, self.writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), self.timeout)
+        
+    # expected 문자열이 나올 때까지 수신 (timeout초 내에 받지 못하면 asyncio.TimeoutError)
+    async def read_until(self, expected):
+        return await asyncio.wait_for(self._read_until(expected), self.timeout)
+    
+    async def _read_until(self, expected):
+        while expected not in self.buffer:
+            data = await self.reader.read(1024)
+            if not data:
+                raise ConnectionError('Telnet 연결이 종료되었습니다')
+            self.buffer += self.negotiate(data)
+            
+        end = self.buffer.index(expected) + len(expected)
+        result, self.buffer = self.buffer[:end], self.buffer[end:]
+        return result
+        
+    # Telnet 옵션 협상은 모두 거절하고 일반 데이터만 반환
+    def negotiate(self, data):
+        data = self.pending + data
+        self.pending = b''
+        
+        result = bytearray()
+        reply = bytearray()
+        i = 0
+        while i < len(data):
+            if data[i] != self.IAC:
+                result.append(data[i])
+                i += 1
+            # 명령이 잘려서 들어온 경우 다음 수신 데이터와 합쳐서 처리
+            elif i + 1 >= len(data) or (data[i + 1] in (self.DO, self.DONT, self.WILL, self.WONT) and i + 2 >= len(data)):
+                self.pending = data[i:]
+                break
+            elif data[i + 1] == self.IAC:
+                result.append(self.IAC)
+                i += 2
+            elif data[i + 1] in (self.DO, self.DONT):
+                reply += bytes([self.IAC, self.WONT, data[i + 2]])
+                i += 3
+            elif data[i + 1] in (self.WILL, self.WONT):
+                reply += bytes([self.IAC, self.DONT, data[i + 2]])
+                i += 3
+            elif data[i + 1] == self.SB:
+                end = data.find(bytes([self.IAC, self.SE]), i + 2)
+                if end < 0:
+                    self.pending = data[i:]
+                    break
+                i = end + 2
+            else:
+                i += 2
+                
+        if reply:
+            self.writer.write(bytes(reply))
+            
+        return bytes(result)
+    
+    async def write(self, data):
+        self.writer.write(data)
+        await asyncio.wait_for(self.writer.drain(), self.timeout)
+        
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            
+
+# 상태 변경 이력 저장소 (시간 순서로 추가만 하는 binary log를 segment 단위로 회전)
+#   - history-<시작 시간 ms>.log: [시간, key 길이, value 길이, key, value] record
+#   - history-<시작 시간 ms>.idx: [시간, log 파일 내 record 위치] 고정 길이 index (mmap 후 binary search)
+class StateHistory:
+    RECORD = struct.Struct('<dHH')
+    INDEX = struct.Struct('<dQ')
+    
+    def __init__(self, path, segment_size, max_segments, retention):
+        self.path = path
+        self.segment_size = segment_size
+        self.max_segments = max_segments
+        self.retention = retention
+        self.data_file = None
+        self.index_file = None
+        self.last_time = 0
+        
+        # event loop에서는 record를 buffer에만 추가하고 파일 기록은 flush에서 처리 (별도 thread에서 실행)
+        self.buffer = []
+        self.buffer_lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        
+        os.makedirs(path, exist_ok=True)
+        
+        # 기존 segment 시작 시간 (오름차순)
+        self.segments = sorted(int(name[8:-4]) / 1000 for name in os.listdir(path) if name.startswith('history-') and name.endswith('.idx'))
+        
+        # 마지막 segment에 이어서 기록
+        if self.segments:
+            self.open_segment(self.segments[-1])
+            last = self.read_index(self.segments[-1])
+            if last:
+                self.last_time = last[-1][0]
+                
+    def segment_file(self, start, ext):
+        return os.path.join(self.path, 'history-{:016d}.{}'.format(int(start * 1000), ext))
+    
+    def open_segment(self, start):
+        self.data_file = open(self.segment_file(start, 'log'), 'ab')
+        self.index_file = open(self.segment_file(start, 'idx'), 'ab')
+        
+    def close(self):
+        if self.data_file is not None:
+            self.data_file.close()
+            self.index_file.close()
+            
+    def append(self, timestamp, key, value):
+        # 시간이 역행하면 binary search가 불가하므로 직전 시간 유지
+        timestamp = max(timestamp, self.last_time)
+        self.last_time = timestamp
+        
+        with self.buffer_lock:
+            self.buffer.append((timestamp, key, value))
+            
+    # buffer의 record를 파일에 기록 (log 파일을 먼저 flush해서 index가 기록되지 않은 record를 가리키지 않도록 함)
+    def flush(self):
+        with self.write_lock:
+            with self.buffer_lock:
+                records, self.buffer = self.buffer, []
+                
+            if not records:
+                return
+            
+            for timestamp, key, value in records:
+                if self.data_file is None or self.data_file.tell() >= self.segment_size:
+                    self.rotate(timestamp)
+                    
+                key = key.encode()
+                value = value.encode()
+                
+                offset = self.data_file.tell()
+                self.data_file.write(self.RECORD.pack(timestamp, len(key), len(value)) + key + value)
+                self.index_file.write(self.INDEX.pack(timestamp, offset))
+                
+            self.data_file.flush()
+            self.index_file.flush()
+        
+    def rotate(self, timestamp):
+        self.close()
+        
+        self.segments.append(timestamp)
+        self.open_segment(timestamp)
+        
+        # 개수 제한 또는 보관 기간을 넘은 segment 삭제 (다음 segment 시작 전까지가 한 segment의 기간)
+        while len(self.segments) > self.max_segments or (len(self.segments) > 1 and self.segments[1] < timestamp - self.retention):
+            start = self.segments.pop(0)
+            for ext in ('log', 'idx'):
+                try:
+                    os.remove(self.segment_file(start, ext))
+                except OSError:
+                    pass
+                
+    # segment index 전체 읽기 (작은 파일에서만 사용)
+    def read_index(self, start):
+        with open(self.segment_file(start, 'idx'), 'rb') as file:
+            data = file.read()
+        count = len(data) // self.INDEX.size
+        return [self.INDEX.unpack_from(data, i * self.INDEX.size) for i in range(count)]
+    
+    # segment의 record를 index 위치 순서대로 읽기 (reverse면 역순)
+    def scan_segment(self, start, begin, end, reverse=False):
+        try:
+            index_file = open(self.segment_file(start, 'idx'), 'rb')
+            data_file = open(self.segment_file(start, 'log'), 'rb')
+        except OSError:
+            return
+            
+        with index_file, data_file:
+            count = os.fstat(index_file.fileno()).st_size // self.INDEX.size
+            data_size = os.fstat(data_file.fileno()).st_size
+            if count == 0 or data_size == 0:
+                return
+            
+            with mmap.mmap(index_file.fileno(), count * self.INDEX.size, access=mmap.ACCESS_READ) as index, \
+                 mmap.mmap(data_file.fileno(), 0, access=mmap.ACCESS_READ) as records:
+                # 시간 index에서 begin 이상인 첫 위치를 binary search
+                lo, hi = 0, count
+                while lo < hi:
+                    mid = (lo + hi) // 2
+                    if self.INDEX.unpack_from(index, mid * self.INDEX.size)[0] < begin:
+                        lo = mid + 1
+                    else:
+                        hi = mid
+                        
+                positions = range(lo - 1, -1, -1) if reverse else range(lo, count)
+                for i in positions:
+                    timestamp, offset = self.INDEX.unpack_from(index, i * self.INDEX.size)
+                    if not reverse and timestamp >= end:
+                        break
+                    # 기록 중 종료되어 잘린 record는 무시
+                    if offset + self.RECORD.size > data_size:
+                        break
+                    
+                    _, key_length, value_length = self.RECORD.unpack_from(records, offset)
+                    key_start = offset + self.RECORD.size
+                    if key_start + key_length + value_length > data_size:
+                        break
+                    
+                    key = records[key_start:key_start + key_length].decode()
+                    value = records[key_start + key_length:key_start + key_length + value_length].decode()
+                    yield timestamp, key, value
+                    
+    # begin <= 시간 < end 구간의 record를 시간 순서로 반환
+    def query(self, begin, end):
+        first = max(bisect.bisect_right(self.segments, begin) - 1, 0)
+        
+        for start in self.segments[first:]:
+            if start >= end:
+                break
+            yield from self.scan_segment(start, begin, end)
+            
+    # begin 직전의 key별 마지막 값 (begin이 속한 segment와 직전 segment만 확인)
+    def last_before(self, begin, match):
+        result = {}
+        first = bisect.bisect_right(self.segments, begin) - 1
+        
+        for start in reversed(self.segments[max(first - 1, 0):first + 1]):
+            for timestamp, key, value in self.scan_segment(start, begin, begin, reverse=True):
+                if match(key) and key not in result:
+                    result[key] = (timestamp, value)
+                    
+        return result
+            
     
 config_dir = '/data'
 
 HA_TOPIC = 'ezville'
 STATE_TOPIC = HA_TOPIC + '/{}/{}/state'
+DEVICE_STATE_TOPIC = HA_TOPIC + '/{}/state'
+ATTRIBUTE_TOPIC = HA_TOPIC + '/{}/{}/attributes'
 EW11_TOPIC = 'ew11'
 EW11_SEND_TOPIC = EW11_TOPIC + '/send'
+HISTORY_TOPIC = HA_TOPIC + '/history'
+AVAILABILITY_TOPIC = HA_TOPIC + '/availability'
 
 
 # Main Function
-def ezville_loop(config):
+#   clock, mqtt_client, telnet, loop는 harness.py처럼 가상 시간과 가짜 MQTT/EW11으로 실행할 때만 전달
+def ezville_loop(config, clock=time.time, mqtt_client=None, telnet=EW11Telnet, loop=None):
     
     # Log 생성 Flag
     debug = config['DEBUG_LOG']
     mqtt_log = config['MQTT_LOG']
     ew11_log = config['EW11_LOG']
     
-    # 통신 모드 설정: mixed, socket, mqtt
+    # 통신 모드 설정: mixed, socket, mqtt, failover
     comm_mode = config['mode']
     
     # Socket 정보
     SOC_ADDRESS = config['ew11_server']
     SOC_PORT = config['ew11_port']
     
-    # EW11 혹은 HA 전달 메시지 저장소
-    MSG_QUEUE = Queue()
+    # EW11 전달 데이터 저장소 ((수신 경로, 데이터), 가득 차면 오래된 데이터부터 삭제) 및 HA 전달 메시지 저장소 (가득 차면 경고 후 삭제)
+    BUS_QUEUE = deque(maxlen=config['bus_queue_size'])
+    CMD_INBOX = Queue(maxsize=config['command_queue_size'])
+    
+    # 밀린 EW11 데이터가 설정 개수를 넘으면 Header별 최신 패킷만 처리
+    BUS_SHED_THRESHOLD = config['bus_shed_threshold']
+    
+    # Queue 최대 사용량 및 삭제된 데이터 수
+    BUS_HWM = 0
+    CMD_HWM = 0
+    BUS_SHED = 0
+    CMD_OVERFLOW = 0
+    QUEUE_METRICS = {}
+    
+    # EW11에 보낼 Command 및 예상 Acknowledge 패킷 (우선순위, 순번, Command 순서의 Heap)
+    CMD_QUEUE = []
+    CMD_SEQUENCE = itertools.count()
+    
+    # 만료 등으로 실행하지 못하고 삭제된 Command 수
+    CMD_DROPPED = 0
+    
+    # 같은 방의 조명/대기전력 명령을 모아서 한번에 전송하기 위한 저장소
+    ROOM_BATCH = {}
+    
+    # State 저장용 공간 ((장치, ROOM ID, 장치 ID)별 Device)
+    DEVICES = {}
+    
+    # 명령 즉시 반영 (Optimistic) 모드 (확인 대기 중인 목표값은 Device.pending에 보관)
+    OPTIMISTIC_MODE = config['optimistic_mode']
     
-    # EW11에 보낼 Command 및 예상 Acknowledge 패킷 
-    CMD_QUEUE = asyncio.Queue()
+    # JSON State 모드는 속성별 State 대신 장치별 JSON State 하나를 Publish (이번 loop에서 바뀐 Device를 모아서 한번에 Publish)
+    JSON_STATE = config['json_state']
+    DIRTY_DEVICES = {}
     
-    # State 저장용 공간
-    DEVICE_STATE = {}
+    # JSON State 모드의 강제 업데이트는 값이 그대로인 Device를 강제 업데이트 기간에 한번만 Publish
+    FORCE_PUBLISHED = set()
     
-    # 이전에 전달된 패킷인지 판단을 위한 캐쉬
+    # 대기전력 전력량 집계용 공간 (ROOM ID, PLUG ID별 최소/최대/평균 및 누적 전력량)
+    PLUG_METER = {}
+    PLUG_PUBLISH_INTERVAL = config['plug_publish_interval']
+    PLUG_DEADBAND = config['plug_deadband']
+    
+    # 상태 변경 이력 저장소 (HISTORY_FLUSH_INTERVAL초마다 파일에 기록, 기록 오류시 저장 중단)
+    HISTORY = None
+    HISTORY_FLUSH_INTERVAL = config['history_flush_interval']
+    if config['history_store']:
+        HISTORY = StateHistory(config_dir + '/history', config['history_segment_size'], config['history_max_segments'], config['history_retention_days'] * 86400)
+    
+    # 이전에 전달된 패킷인지 판단을 위한 캐쉬 ((장치 ID, 그룹 ID, 데이터 길이)별 데이터 BYTE)
     MSG_CACHE = {}
     
-    # MQTT Discovery Que
+    # MQTT Discovery Delay (등록 여부는 Device.discovered에 보관)
     DISCOVERY_DELAY = config['discovery_delay']
-    DISCOVERY_LIST = []
     
-    # EW11 전달 패킷 중 처리 후 남은 짜투리 패킷 저장
-    RESIDUE = ''
+    # HA 재시작 시 다시 등록하기 위한 Discovery 메시지 저장소
+    DISCOVERY_PUBLISHED = []
+    
+    # 재시작 시 바로 장치 등록 및 전력량 누적을 이어가기 위한 Snapshot (Device State, 대기전력 누적 전력량)
+    SNAPSHOT_STORE = config['snapshot_store']
+    SNAPSHOT_INTERVAL = config['snapshot_interval']
+    SNAPSHOT_FILE = config_dir + '/snapshot.json'
+    
+    # Snapshot에서 읽은 누적 전력량 (첫 전력값을 받을 때 PLUG_METER로 이동)
+    PLUG_ENERGY = {}
+    
+    # EW11 전달 패킷 중 처리 후 남은 짜투리 패킷 저장 (수신 경로별)
+    RESIDUE = {}
+    
+    # Failover 모드는 MQTT와 socket 경로로 모두 수신하고 경로별 마지막 패킷 수신 시간으로 전송 경로 선택
+    FAILOVER_TIMEOUT = config['failover_timeout']
+    FAILOVER_DEDUP_WINDOW = config['failover_dedup_window']
+    PATH_SEEN = {'mqtt': clock(), 'socket': clock()}
+    ACTIVE_PATH = 'socket'
+    
+    # 두 경로로 같이 들어온 패킷 중복 제거용 (패킷: [처음 받은 경로, 마지막 수신 시간, 다른 경로에서 받을 남은 수])
+    RECENT_PACKETS = {}
     
     # 강제 주기적 업데이트 설정 - 매 force_update_period 마다 force_update_duration초간 HA 업데이트 실시
     FORCE_UPDATE = False
+    FORCE_REQUEST = False
     FORCE_MODE = config['force_update_mode']
     FORCE_PERIOD = config['force_update_period']
     FORCE_DURATION = config['force_update_duration']
@@ -231,6 +710,22 @@ def ezville_loop(config):
     FIRST_WAITTIME = config['first_waittime']
     RANDOM_BACKOFF = config['random_backoff']
     
+    # 명령 후 STATE_QUERY_DELAY초 안에 확인되지 않으면 상태 요구 패킷 전송 (같은 패킷은 STATE_QUERY_INTERVAL초에 한번만)
+    STATE_QUERY = config['state_query']
+    STATE_QUERY_DELAY = config['state_query_delay']
+    STATE_QUERY_INTERVAL = config['state_query_interval']
+    QUERY_SENT = {}
+    
+    # 같은 방의 조명/대기전력 명령을 모으는 시간
+    BATCH_WINDOW = config['command_batch_window']
+    
+    # 우선순위별 Command 유효 시간 (초과시 실행하지 않고 삭제)
+    CMD_DEADLINE = {
+        'safety': config['command_deadline_safety'],
+        'interactive': config['command_deadline_interactive'],
+        'automation': config['command_deadline_automation']
+    }
+    
     # State 업데이트 루프 / Command 실행 루프 / Socket 통신으로 패킷 받아오는 루프 / Restart 필요한지 체크하는 루프의 Delay Time 설정
     STATE_LOOP_DELAY = config['state_loop_delay']
     COMMAND_LOOP_DELAY = config['command_loop_delay']
@@ -242,17 +737,38 @@ def ezville_loop(config):
     
     # EW11 동작상태 확인용 메시지 수신 시간 체크 주기 및 체크용 시간 변수
     EW11_TIMEOUT = config['ew11_timeout']
-    last_received_time = time.time()
+    EW11_HEALTH_CHECK_DELAY = config['ew11_health_check_delay']
+    EW11_RESET_TIMEOUT = config['ew11_reset_timeout']
+    last_received_time = clock()
+    
+    # EW11 리셋 Task (event loop를 막지 않도록 별도 task로 실행)
+    reset_task = None
     
     # EW11 재시작 확인용 Flag
     restart_flag = False
+    
+    # 통신 복구 시간 측정용 변수 (MQTT 연결 해제 시간, EW11 재시작 시간, HA 온라인 시간)
+    mqtt_disconnected_time = None
+    mqtt_recovery_time = None
+    ew11_recovery_start = None
+    ha_online_time = None
+    rediscovery_time = None
   
-    # MQTT Integration 활성화 확인 Flag - 단, 사용을 위해서는 MQTT Integration에서 Birth/Last Will Testament 설정 및 Retain 설정 필요
-    MQTT_ONLINE = False
+    # MQTT Broker 연결 및 MQTT Integration 활성화 확인 Event (paho thread에서는 call_soon_threadsafe로 설정)
+    #   MQTT Integration 확인을 위해서는 MQTT Integration에서 Birth/Last Will Testament 설정 및 Retain 설정 필요
+    MQTT_CONNECTED = asyncio.Event()
+    HA_ONLINE = asyncio.Event()
+    
+    # 시작 후 첫 EW11 패킷 수신 확인 Event (시작 단계별 시간 기록용)
+    BUS_RECEIVED = asyncio.Event()
     
     # Addon 정상 시작 Flag
     ADDON_STARTED = False
  
+    # Socket 연결 및 재연결 Lock
+    soc = None
+    socket_lock = asyncio.Lock()
+    
     # Reboot 이후 안정적인 동작을 위한 제어 Flag
     REBOOT_CONTROL = config['reboot_control']
     REBOOT_DELAY = config['reboot_delay']
@@ -263,13 +779,27 @@ def ezville_loop(config):
 
     # MQTT 통신 연결 Callback
     def on_connect(client, userdata, flags, rc):
+        nonlocal mqtt_disconnected_time
+        nonlocal mqtt_recovery_time
+        
         if rc == 0:
             log('[INFO] MQTT Broker 연결 성공')
+            loop.call_soon_threadsafe(MQTT_CONNECTED.set)
+            
+            # 연결 해제 후 재연결된 경우 복구 시간 기록
+            if mqtt_disconnected_time is not None:
+                mqtt_recovery_time = clock() - mqtt_disconnected_time
+                mqtt_disconnected_time = None
+                
+            # 연결이 끊어졌을 때 Broker가 보낸 Last Will (offline)을 다시 online으로 변경
+            if ADDON_STARTED:
+                client.publish(AVAILABILITY_TOPIC, 'online', retain=True)
+                
             # Socket인 경우 MQTT 장치의 명령 관련과 MQTT Status (Birth/Last Will Testament) Topic만 구독
             if comm_mode == 'socket':
                 client.subscribe([(HA_TOPIC + '/#', 0), ('homeassistant/status', 0)])
-            # Mixed인 경우 MQTT 장치 및 EW11의 명령/수신 관련 Topic 과 MQTT Status (Birth/Last Will Testament) Topic 만 구독
-            elif comm_mode == 'mixed':
+            # Mixed/Failover인 경우 MQTT 장치 및 EW11의 명령/수신 관련 Topic 과 MQTT Status (Birth/Last Will Testament) Topic 만 구독
+            elif comm_mode == 'mixed' or comm_mode == 'failover':
                 client.subscribe([(HA_TOPIC + '/#', 0), (EW11_TOPIC + '/recv', 0), ('homeassistant/status', 0)])
             # MQTT 인 경우 모든 Topic 구독
             else:
@@ -285,9 +815,11 @@ def ezville_loop(config):
         
     # MQTT 메시지 Callback
     def on_message(client, userdata, msg):
-        nonlocal MSG_QUEUE
-        nonlocal MQTT_ONLINE
+        nonlocal CMD_HWM
+        nonlocal CMD_OVERFLOW
         nonlocal startup_delay
+        nonlocal ha_online_time
+        nonlocal rediscovery_time
         
         if msg.topic == 'homeassistant/status':
             # Reboot Control 사용 시 MQTT Integration의 Birth/Last Will Testament Topic은 바로 처리
@@ -296,346 +828,694 @@ def ezville_loop(config):
                 
                 if status == 'online':
                     log('[INFO] MQTT Integration 온라인')
-                    MQTT_ONLINE = True
+                    loop.call_soon_threadsafe(HA_ONLINE.set)
                     if not msg.retain:
                         log('[INFO] MQTT Birth Message가 Retain이 아니므로 정상화까지 Delay 부여')
                         startup_delay = REBOOT_DELAY
+                    
+                    # 동작 중 HA가 재시작된 경우 장치 재등록 예약
+                    if ADDON_STARTED:
+                        ha_online_time = clock()
+                        rediscovery_time = ha_online_time + startup_delay
                 elif status == 'offline':
                     log('[INFO] MQTT Integration 오프라인')
-                    MQTT_ONLINE = False
-        # 나머지 topic은 모두 Queue에 보관
-        else:
-            MSG_QUEUE.put(msg)
+                    loop.call_soon_threadsafe(HA_ONLINE.clear)
+        # EW11 수신 데이터는 BUS_QUEUE에 보관
+        elif msg.topic == EW11_TOPIC + '/recv':
+            queue_bus_data(msg.payload, 'mqtt')
+        # HA 명령 및 이력 조회 요청은 CMD_INBOX에 보관 (자신이 Publish한 State 등은 무시)
+        elif msg.topic.startswith(HA_TOPIC + '/') and (msg.topic.endswith('/command') or msg.topic == HISTORY_TOPIC + '/query'):
+            try:
+                CMD_INBOX.put_nowait(msg)
+                CMD_HWM = max(CMD_HWM, CMD_INBOX.qsize())
+            except Full:
+                CMD_OVERFLOW += 1
+                log('[WARNING] 명령 Queue가 가득 차서 다음 명령을 처리하지 못했습니다: {} {}'.format(msg.topic, msg.payload))
+            
+    
+    # EW11 수신 데이터를 수신 경로 (mqtt/socket)와 함께 보관 (BUS_QUEUE가 가득 차면 가장 오래된 데이터가 삭제됨)
+    def queue_bus_data(payload, path):
+        nonlocal BUS_HWM
+        nonlocal BUS_SHED
+        
+        if len(BUS_QUEUE) == BUS_QUEUE.maxlen:
+            BUS_SHED += 1
+            
+        BUS_QUEUE.append((path, payload))
+        BUS_HWM = max(BUS_HWM, len(BUS_QUEUE))
  
 
     # MQTT 통신 연결 해제 Callback
     def on_disconnect(client, userdata, rc):
+        nonlocal mqtt_disconnected_time
+        
         log('INFO: MQTT 연결 해제')
-        pass
+        loop.call_soon_threadsafe(MQTT_CONNECTED.clear)
+        
+        # 재연결은 paho loop가 자동으로 진행하며 복구 시간 측정을 위해 시간만 기록
+        if mqtt_disconnected_time is None:
+            mqtt_disconnected_time = clock()
 
 
     # MQTT message를 분류하여 처리
     async def process_message():
-        # MSG_QUEUE의 message를 하나씩 pop
-        nonlocal MSG_QUEUE
         nonlocal last_received_time
         
-        stop = False
-        while not stop:
-            if MSG_QUEUE.empty():
-                stop = True
-            else:
-                msg = MSG_QUEUE.get()
-                topics = msg.topic.split('/')
-
-                if topics[0] == HA_TOPIC and topics[-1] == 'command':
-                    await HA_process(topics, msg.payload.decode('utf-8'))
-                elif topics[0] == EW11_TOPIC and topics[-1] == 'recv':
-                    # Que에서 확인된 시간 기준으로 EW11 Health Check함.
-                    last_received_time = time.time()
+        # HA 명령을 먼저 처리
+        while not CMD_INBOX.empty():
+            msg = CMD_INBOX.get()
+            topics = msg.topic.split('/')
 
-                    await EW11_process(msg.payload.hex().upper())
+            if topics[-1] == 'command':
+                await HA_process(topics, msg.payload.decode('utf-8'))
+            elif msg.topic == HISTORY_TOPIC + '/query':
+                await history_query(msg.payload.decode('utf-8'))
+        
+        # 처리가 밀린 경우 모아서 Header별 최신 패킷만 처리, 아니면 받은 순서대로 처리
+        count = len(BUS_QUEUE)
+        if count > 0:
+            # Que에서 확인된 시간 기준으로 EW11 Health Check함.
+            last_received_time = clock()
+            BUS_RECEIVED.set()
+            
+        if count > BUS_SHED_THRESHOLD:
+            # 수신 경로별로 이어 붙여서 처리
+            chunks = {}
+            for _ in range(count):
+                path, payload = BUS_QUEUE.popleft()
+                chunks.setdefault(path, []).append(payload)
+                
+            for path, payloads in chunks.items():
+                await EW11_process(b''.join(payloads), path, shed=True)
+        else:
+            for _ in range(count):
+                path, payload = BUS_QUEUE.popleft()
+                await EW11_process(payload, path)
+                
+        await publish_queue_metrics()
+        
+        
+    # Queue 최대 사용량 및 삭제 데이터 수가 바뀌면 Publish
+    async def publish_queue_metrics():
+        for state, value in (('busQueueHwm', BUS_HWM), ('cmdQueueHwm', CMD_HWM), ('busShed', BUS_SHED), ('cmdOverflow', CMD_OVERFLOW)):
+            if QUEUE_METRICS.get(state) != value:
+                QUEUE_METRICS[state] = value
+                await publish_metric(state, str(value))
                    
     
     # EW11 전달된 메시지 처리
-    async def EW11_process(raw_data):
-        nonlocal DISCOVERY_LIST
-        nonlocal RESIDUE
+    async def EW11_process(raw_data, path, shed=False):
         nonlocal MSG_CACHE
-        nonlocal DEVICE_STATE       
+        nonlocal BUS_SHED
         
-        raw_data = RESIDUE + raw_data
+        raw_data = RESIDUE.pop(path, b'') + raw_data
         
         if ew11_log:
-            log('[SIGNAL] receved: {}'.format(raw_data))
+            log('[SIGNAL] receved: {}'.format(raw_data.hex().upper()))
         
         k = 0
-        cors = []
+        packets = []
         msg_length = len(raw_data)
-        while k < msg_length:
+        while True:
             # F7로 시작하는 패턴을 패킷으로 분리
-            if raw_data[k:k + 2] == 'F7':
-                # 남은 데이터가 최소 패킷 길이를 만족하지 못하면 RESIDUE에 저장 후 종료
-                if k + 10 > msg_length:
-                    RESIDUE = raw_data[k:]
-                    break
-                else:
-                    data_length = int(raw_data[k + 8:k + 10], 16)
-                    packet_length = 10 + data_length * 2 + 4 
+            k = raw_data.find(0xF7, k)
+            if k < 0:
+                break
+            
+            # 남은 데이터가 최소 패킷 길이를 만족하지 못하면 RESIDUE에 저장 후 종료
+            if k + 5 > msg_length:
+                RESIDUE[path] = raw_data[k:]
+                break
+            
+            packet_length = 5 + raw_data[k + 4] + 2
+            
+            # 남은 데이터가 예상되는 패킷 길이보다 짧으면 RESIDUE에 저장 후 종료
+            if k + packet_length > msg_length:
+                RESIDUE[path] = raw_data[k:]
+                break
+            
+            packet = raw_data[k:k + packet_length]
+                
+            # 분리된 패킷이 Valid한 패킷인지 Checksum 확인                
+            if not verify_checksum(packet):
+                k += 1
+                continue
+            
+            packets.append(packet)
+            k += packet_length
+            
+        # Failover 모드는 경로별 수신 시간을 기록하고 다른 경로로 이미 받은 패킷은 제외
+        if comm_mode == 'failover' and packets:
+            timestamp = clock()
+            PATH_SEEN[path] = timestamp
+            packets = [packet for packet in packets if not duplicate_packet(packet, path, timestamp)]
+                
+        # 처리가 밀린 경우 같은 Header (장치 ID, 그룹 ID, 명령)의 패킷은 마지막 패킷만 처리
+        if shed:
+            latest = {}
+            for packet in packets:
+                latest.pop(packet[0:4], None)
+                latest[packet[0:4]] = packet
+                
+            BUS_SHED += len(packets) - len(latest)
+            packets = list(latest.values())
+                
+        for packet in packets:
+            STATE_PACKET = False
+            ACK_PACKET = False
+            
+            # STATE 패킷인지 확인
+            if packet[1] in STATE_CODE and packet[3] == STATE_CODE[packet[1]][1]:
+                STATE_PACKET = True
+            # ACK 패킷인지 확인
+            elif packet[1] in ACK_CODE and packet[3] == ACK_CODE[packet[1]][1]:
+                ACK_PACKET = True
+            
+            if STATE_PACKET or ACK_PACKET:
+                name = STATE_CODE[packet[1]][0]
+                
+                # ACK 패킷도 State 패킷과 같은 형식이므로 State 패킷 캐쉬와 비교 (난방은 전체 그룹 1F로 저장)
+                cache_key = (packet[1], 0x1F if name == 'thermostat' else packet[2], packet[4])
+                
+                prev_data = MSG_CACHE.get(cache_key)
+                data = packet[5:-2]
+                
+                # MSG_CACHE에 없는 새로운 패킷이거나 FORCE_UPDATE 실행된 경우만 실행
+                if prev_data != data or FORCE_UPDATE:
+                    # 이전 패킷과 달라진 BYTE만 decode (처음 받은 패킷이나 FORCE_UPDATE는 전체 decode)
+                    changed = None if FORCE_UPDATE else diff_bytes(prev_data, data, 5)
                     
-                    # 남은 데이터가 예상되는 패킷 길이보다 짧으면 RESIDUE에 저장 후 종료
-                    if k + packet_length > msg_length:
-                        RESIDUE = raw_data[k:]
-                        break
-                    else:
-                        packet = raw_data[k:k + packet_length]
+                    if name == 'light':
+                        # ROOM ID
+                        rid = packet[2] & 0x0F
+                        # ROOM의 light 갯수 + 1
+                        slc = packet[4]
                         
-                # 분리된 패킷이 Valid한 패킷인지 Checksum 확인                
-                if packet != checksum(packet):
-                    k+=1
-                    continue
-                else:
-                    STATE_PACKET = False
-                    ACK_PACKET = False
-                    
-                    # STATE 패킷인지 확인
-                    if packet[2:4] in STATE_HEADER and packet[6:8] in STATE_HEADER[packet[2:4]][1]:
-                        STATE_PACKET = True
-                    # ACK 패킷인지 확인
-                    elif packet[2:4] in ACK_HEADER and packet[6:8] in ACK_HEADER[packet[2:4]][1]:
-                        ACK_PACKET = True
-                    
-                    if STATE_PACKET or ACK_PACKET:
-                        # MSG_CACHE에 없는 새로운 패킷이거나 FORCE_UPDATE 실행된 경우만 실행
-                        if MSG_CACHE.get(packet[0:10]) != packet[10:] or FORCE_UPDATE:
-                            name = STATE_HEADER[packet[2:4]][0]                            
-                            if name == 'light':
-                                # ROOM ID
-                                rid = int(packet[5], 16)
-                                # ROOM의 light 갯수 + 1
-                                slc = int(packet[8:10], 16) 
-                                
-                                for id in range(1, slc):
-                                    discovery_name = '{}_{:0>2d}_{:0>2d}'.format(name, rid, id)
-                                    
-                                    if discovery_name not in DISCOVERY_LIST:
-                                        DISCOVERY_LIST.append(discovery_name)
-                                    
-                                        payload = DISCOVERY_PAYLOAD[name][0].copy()
-                                        payload['~'] = payload['~'].format(rid, id)
-                                        payload['name'] = payload['name'].format(rid, id)
-                                   
-                                        # 장치 등록 후 DISCOVERY_DELAY초 후에 State 업데이트
-                                        await mqtt_discovery(payload)
-                                        await asyncio.sleep(DISCOVERY_DELAY)
-                                    
-                                    # State 업데이트까지 진행
-                                    onoff = 'ON' if int(packet[10 + 2 * id: 12 + 2 * id], 16) > 0 else 'OFF'
-                                        
-                                    await update_state(name, 'power', rid, id, onoff)
-                                    
-                                    # 직전 처리 State 패킷은 저장
-                                    if STATE_PACKET:
-                                        MSG_CACHE[packet[0:10]] = packet[10:]
-                                                                                    
-                            elif name == 'thermostat':
-                                # room 갯수
-                                rc = int((int(packet[8:10], 16) - 5) / 2)
-                                # room의 조절기 수 (현재 하나 뿐임)
-                                src = 1
-                                
-                                onoff_state = bin(int(packet[12:14], 16))[2:].zfill(8)
-                                away_state = bin(int(packet[14:16], 16))[2:].zfill(8)
-                                
-                                for rid in range(1, rc + 1):
-                                    discovery_name = '{}_{:0>2d}_{:0>2d}'.format(name, rid, src)
-                                    
-                                    if discovery_name not in DISCOVERY_LIST:
-                                        DISCOVERY_LIST.append(discovery_name)
-                                    
-                                        payload = DISCOVERY_PAYLOAD[name][0].copy()
-                                        payload['~'] = payload['~'].format(rid, src)
-                                        payload['name'] = payload['name'].format(rid, src)
-                                   
-                                        # 장치 등록 후 DISCOVERY_DELAY초 후에 State 업데이트
-                                        await mqtt_discovery(payload)
-                                        await asyncio.sleep(DISCOVERY_DELAY)
-                                    
-                                    setT = str(int(packet[16 + 4 * rid:18 + 4 * rid], 16))
-                                    curT = str(int(packet[18 + 4 * rid:20 + 4 * rid], 16))
-                                    
-                                    if onoff_state[8 - rid ] == '1':
-                                        onoff = 'heat'
-                                    # 외출 모드는 off로 
-                                    elif onoff_state[8 - rid] == '0' and away_state[8 - rid] == '1':
-                                        onoff = 'off'
-#                                    elif onoff_state[8 - rid] == '0' and away_state[8 - rid] == '0':
-#                                        onoff = 'off'
-#                                    else:
-#                                        onoff = 'off'
-
-                                    await update_state(name, 'power', rid, src, onoff)
-                                    await update_state(name, 'curTemp', rid, src, curT)
-                                    await update_state(name, 'setTemp', rid, src, setT)
-                                    
-                                # 직전 처리 State 패킷은 저장
-                                if STATE_PACKET:
-                                    MSG_CACHE[packet[0:10]] = packet[10:]
-                                else:
-                                    # Ack 패킷도 State로 저장
-                                    MSG_CACHE['F7361F810F'] = packet[10:]
-                                        
-                            # plug는 ACK PACKET에 상태 정보가 없으므로 STATE_PACKET만 처리
-                            elif name == 'plug' and STATE_PACKET:
-                                if STATE_PACKET:
-                                    # ROOM ID
-                                    rid = int(packet[5], 16)
-                                    # ROOM의 plug 갯수
-                                    spc = int(packet[10:12], 16) 
+                        for id in range(1, slc):
+                            # 상태 BYTE가 바뀌지 않은 조명은 건너뜀
+                            if changed is not None and 5 + id not in changed:
+                                continue
+                            
+                            await discover_device(name, rid, id)
+                            
+                            # State 업데이트까지 진행
+                            onoff = 'ON' if packet[5 + id] > 0 else 'OFF'
                                 
-                                    for id in range(1, spc + 1):
-                                        discovery_name = '{}_{:0>2d}_{:0>2d}'.format(name, rid, id)
+                            await update_state(name, 'power', rid, id, onoff)
+                            
+                        # 직전 처리 패킷은 저장
+                        MSG_CACHE[cache_key] = data
+                                                                            
+                    elif name == 'thermostat':
+                        # room 갯수
+                        rc = (packet[4] - 5) // 2
+                        # room의 조절기 수 (현재 하나 뿐임)
+                        src = 1
+                        
+                        onoff_state = packet[6]
+                        away_state = packet[7]
+                        
+                        # 난방/외출 상태 BYTE가 바뀌었는지 확인
+                        mode_changed = changed is None or 6 in changed or 7 in changed
+                        
+                        for rid in range(1, rc + 1):
+                            # 설정온도 BYTE: 8 + 2 * rid, 현재온도 BYTE: 9 + 2 * rid
+                            set_changed = changed is None or 8 + 2 * rid in changed
+                            cur_changed = changed is None or 9 + 2 * rid in changed
+                            
+                            if not (mode_changed or set_changed or cur_changed):
+                                continue
+                            
+                            await discover_device(name, rid, src)
+                            
+                            if mode_changed:
+                                # ROOM별 상태는 BIT (rid - 1)
+                                if onoff_state >> (rid - 1) & 1:
+                                    onoff = 'heat'
+                                # 외출 모드는 off로 
+                                elif away_state >> (rid - 1) & 1:
+                                    onoff = 'off'
 
-                                        if discovery_name not in DISCOVERY_LIST:
-                                            DISCOVERY_LIST.append(discovery_name)
-                                    
-                                            for payload_template in DISCOVERY_PAYLOAD[name]:
-                                                payload = payload_template.copy()
-                                                payload['~'] = payload['~'].format(rid, id)
-                                                payload['name'] = payload['name'].format(rid, id)
-                                   
-                                                # 장치 등록 후 DISCOVERY_DELAY초 후에 State 업데이트
-                                                await mqtt_discovery(payload)
-                                                await asyncio.sleep(DISCOVERY_DELAY)  
-                                    
-                                        # BIT0: 대기전력 On/Off, BIT1: 자동모드 On/Off
-                                        # 위와 같지만 일단 on-off 여부만 판단
-                                        onoff = 'ON' if int(packet[7 + 6 * id], 16) > 0 else 'OFF'
-                                        autoonoff = 'ON' if int(packet[6 + 6 * id], 16) > 0 else 'OFF'
-                                        power_num = '{:.2f}'.format(int(packet[8 + 6 * id: 12 + 6 * id], 16) / 100)
-                                        
-                                        await update_state(name, 'power', rid, id, onoff)
-                                        await update_state(name, 'auto', rid, id, onoff)
-                                        await update_state(name, 'current', rid, id, power_num)
-                                    
-                                        # 직전 처리 State 패킷은 저장
-                                        MSG_CACHE[packet[0:10]] = packet[10:]
-                                else:
-                                    # ROOM ID
-                                    rid = int(packet[5], 16)
-                                    # ROOM의 plug 갯수
-                                    sid = int(packet[10:12], 16) 
+                                await update_state(name, 'power', rid, src, onoff)
                                 
-                                    onoff = 'ON' if int(packet[13], 16) > 0 else 'OFF'
-                                    
-                                    await update_state(name, 'power', rid, id, onoff)
-                                        
-                            elif name == 'gasvalve':
-                                # Gas Value는 하나라서 강제 설정
-                                rid = 1
-                                # Gas Value는 하나라서 강제 설정
-                                spc = 1 
+                            if cur_changed:
+                                curT = str(packet[9 + 2 * rid])
+                                await update_state(name, 'curTemp', rid, src, curT)
                                 
-                                discovery_name = '{}_{:0>2d}_{:0>2d}'.format(name, rid, spc)
-                                    
-                                if discovery_name not in DISCOVERY_LIST:
-                                    DISCOVERY_LIST.append(discovery_name)
-                                    
-                                    payload = DISCOVERY_PAYLOAD[name][0].copy()
-                                    payload['~'] = payload['~'].format(rid, spc)
-                                    payload['name'] = payload['name'].format(rid, spc)
-                                   
-                                    # 장치 등록 후 DISCOVERY_DELAY초 후에 State 업데이트
-                                    await mqtt_discovery(payload)
-                                    await asyncio.sleep(DISCOVERY_DELAY)                                
-
-                                onoff = 'ON' if int(packet[12:14], 16) == 1 else 'OFF'
-                                        
-                                await update_state(name, 'power', rid, spc, onoff)
+                            if set_changed:
+                                setT = str(packet[8 + 2 * rid])
+                                await update_state(name, 'setTemp', rid, src, setT)
+                            
+                        # 직전 처리 패킷은 저장 (Ack 패킷도 State로 저장)
+                        MSG_CACHE[cache_key] = data
                                 
-                                # 직전 처리 State 패킷은 저장
-                                if STATE_PACKET:
-                                    MSG_CACHE[packet[0:10]] = packet[10:]
+                    # plug는 ACK PACKET에 상태 정보가 없으므로 STATE_PACKET만 처리
+                    elif name == 'plug' and STATE_PACKET:
+                        # ROOM ID
+                        rid = packet[2] & 0x0F
+                        # ROOM의 plug 갯수
+                        spc = packet[5]
+                    
+                        for id in range(1, spc + 1):
+                            # 상태 BYTE: 3 + 3 * id, 전력량 BYTE: 4 + 3 * id ~ 5 + 3 * id
+                            power_changed = changed is None or 3 + 3 * id in changed
+                            current_changed = changed is None or 4 + 3 * id in changed or 5 + 3 * id in changed
+                            
+                            if not (power_changed or current_changed):
+                                continue
+                            
+                            await discover_device(name, rid, id)
+                        
+                            # 상태 BYTE 하위 4 BIT: 대기전력 On/Off, 상위 4 BIT: 자동모드 On/Off
+                            # 위와 같지만 일단 on-off 여부만 판단
+                            if power_changed:
+                                onoff = 'ON' if packet[3 + 3 * id] & 0x0F > 0 else 'OFF'
+                                autoonoff = 'ON' if packet[3 + 3 * id] >> 4 > 0 else 'OFF'
                             
-                            # 일괄차단기 ACK PACKET은 상태 업데이트에 반영하지 않음
-                            elif name == 'batch' and STATE_PACKET:
-                                # 일괄차단기는 하나라서 강제 설정
-                                rid = 1
-                                # 일괄차단기는 하나라서 강제 설정
-                                sbc = 1
+                                await update_state(name, 'power', rid, id, onoff)
+                                await update_state(name, 'auto', rid, id, onoff)
                                 
-                                discovery_name = '{}_{:0>2d}_{:0>2d}'.format(name, rid, sbc)
+                            if current_changed:
+                                power_num = int.from_bytes(packet[4 + 3 * id:6 + 3 * id], 'big') / 100
                                 
-                                if discovery_name not in DISCOVERY_LIST:
-                                    DISCOVERY_LIST.append(discovery_name)
-                                    
-                                    for payload_template in DISCOVERY_PAYLOAD[name]:
-                                        payload = payload_template.copy()
-                                        payload['~'] = payload['~'].format(rid, sbc)
-                                        payload['name'] = payload['name'].format(rid, sbc)
-                                   
-                                        # 장치 등록 후 DISCOVERY_DELAY초 후에 State 업데이트
-                                        await mqtt_discovery(payload)
-                                        await asyncio.sleep(DISCOVERY_DELAY)           
-
-                                # 일괄 차단기는 버튼 상태 변수 업데이트
-                                states = bin(int(packet[12:14], 16))[2:].zfill(8)
-                                        
-                                ELEVDOWN = states[2]                                        
-                                ELEVUP = states[3]
-                                GROUPON = states[5]
-                                OUTING = states[6]
-                                                                    
-                                grouponoff = 'ON' if GROUPON == '1' else 'OFF'
-                                outingonoff = 'ON' if OUTING == '1' else 'OFF'
+                                await feed_plug_meter(rid, id, power_num)
+                        
+                        # 직전 처리 State 패킷은 저장
+                        MSG_CACHE[cache_key] = data
                                 
-                                #ELEVDOWN과 ELEVUP은 직접 DEVICE_STATE에 저장
-                                elevdownonoff = 'ON' if ELEVDOWN == '1' else 'OFF'
-                                elevuponoff = 'ON' if ELEVUP == '1' else 'OFF'
-                                DEVICE_STATE['batch_01_01elevator-up'] = elevuponoff
-                                DEVICE_STATE['batch_01_01elevator-down'] = elevdownonoff
-                                    
-                                # 일괄 조명 및 외출 모드는 상태 업데이트
-                                await update_state(name, 'group', rid, sbc, grouponoff)
-                                await update_state(name, 'outing', rid, sbc, outingonoff)
+                    elif name == 'gasvalve':
+                        # Gas Value는 하나라서 강제 설정
+                        rid = 1
+                        # Gas Value는 하나라서 강제 설정
+                        spc = 1 
+                        
+                        await discover_device(name, rid, spc)
+
+                        if changed is None or 6 in changed:
+                            onoff = 'ON' if packet[6] == 1 else 'OFF'
                                 
-                                MSG_CACHE[packet[0:10]] = packet[10:]
-                                                                                    
-                RESIDUE = ''
-                k = k + packet_length
+                            await update_state(name, 'power', rid, spc, onoff)
+                        
+                        # 직전 처리 패킷은 저장
+                        MSG_CACHE[cache_key] = data
+                    
+                    # 일괄차단기 ACK PACKET은 상태 업데이트에 반영하지 않음
+                    elif name == 'batch' and STATE_PACKET:
+                        # 일괄차단기는 하나라서 강제 설정
+                        rid = 1
+                        # 일괄차단기는 하나라서 강제 설정
+                        sbc = 1
+                        
+                        device = await discover_device(name, rid, sbc)
+
+                        if changed is None or 6 in changed:
+                            # 일괄 차단기는 버튼 상태 변수 업데이트 (BIT5: 엘리베이터 하행, BIT4: 상행, BIT2: 그룹 조명, BIT1: 외출)
+                            states = packet[6]
+                                
+                            ELEVDOWN = states >> 5 & 1
+                            ELEVUP = states >> 4 & 1
+                            GROUPON = states >> 2 & 1
+                            OUTING = states >> 1 & 1
+                                                            
+                            grouponoff = 'ON' if GROUPON else 'OFF'
+                            outingonoff = 'ON' if OUTING else 'OFF'
+                        
+                            #ELEVDOWN과 ELEVUP은 직접 Device에 저장
+                            elevdownonoff = 'ON' if ELEVDOWN else 'OFF'
+                            elevuponoff = 'ON' if ELEVUP else 'OFF'
+                            device.set('elevator-up', elevuponoff)
+                            device.set('elevator-down', elevdownonoff)
+                            
+                            # 일괄 조명 및 외출 모드는 상태 업데이트
+                            await update_state(name, 'group', rid, sbc, grouponoff)
+                            await update_state(name, 'outing', rid, sbc, outingonoff)
+                        
+                        MSG_CACHE[cache_key] = data
+                
+                
+    # 다른 경로에서 FAILOVER_DEDUP_WINDOW초 안에 받은 같은 패킷이면 중복으로 판단
+    def duplicate_packet(packet, path, timestamp):
+        seen = RECENT_PACKETS.get(packet)
+        
+        if seen is not None and timestamp - seen[1] <= FAILOVER_DEDUP_WINDOW:
+            # 다른 경로에서 먼저 받은 패킷 수만큼 중복으로 처리
+            if seen[0] != path:
+                seen[2] -= 1
+                if seen[2] == 0:
+                    del RECENT_PACKETS[packet]
+                return True
+            
+            seen[1] = timestamp
+            seen[2] += 1
+            return False
+        
+        RECENT_PACKETS[packet] = [path, timestamp, 1]
+        return False
+        
+        
+    # 전송 경로의 패킷이 FAILOVER_TIMEOUT초 이상 끊기고 다른 경로가 정상이면 전송 경로 전환
+    async def check_transport():
+        nonlocal ACTIVE_PATH
+        
+        timestamp = clock()
+        
+        # 중복 확인 시간이 지난 패킷 정리
+        for packet in [packet for packet, seen in RECENT_PACKETS.items() if timestamp - seen[1] > FAILOVER_DEDUP_WINDOW]:
+            del RECENT_PACKETS[packet]
+            
+        standby = 'mqtt' if ACTIVE_PATH == 'socket' else 'socket'
+        
+        if timestamp - PATH_SEEN[ACTIVE_PATH] > FAILOVER_TIMEOUT and timestamp - PATH_SEEN[standby] <= FAILOVER_TIMEOUT:
+            switch_path(standby, '{:.1f}초간 패킷 수신 없음'.format(timestamp - PATH_SEEN[ACTIVE_PATH]))
+            
+        await publish_metric('activePath', ACTIVE_PATH)
+        
+        
+    def switch_path(path, reason):
+        nonlocal ACTIVE_PATH
+        
+        log('[WARNING] EW11 전송 경로 전환: {} -> {} ({})'.format(ACTIVE_PATH, path, reason))
+        ACTIVE_PATH = path
+        
+        
+    # (장치, ROOM ID, 장치 ID)로 Device 조회 (없으면 생성)
+    def get_device(device, rid, sid):
+        key = (device, rid, sid)
+        
+        if key not in DEVICES:
+            DEVICES[key] = Device(device, rid, sid)
+        
+        return DEVICES[key]
+        
+        
+    # 처음 받은 장치는 MQTT Discovery 등록 후 DISCOVERY_DELAY초 후에 State 업데이트 (시작 준비 중에는 등록하지 않고 State만 보관)
+    async def discover_device(device, rid, sid):
+        target = get_device(device, rid, sid)
+        
+        if not target.discovered and ADDON_STARTED:
+            target.discovered = True
+            
+            for payload_template in DISCOVERY_PAYLOAD[device]:
+                # 전송 경로 Sensor는 failover 모드만 등록
+                if payload_template.get('stat_t') == '~/activePath/state' and comm_mode != 'failover':
+                    continue
+                
+                payload = payload_template.copy()
+                payload['~'] = payload['~'].format(rid, sid)
+                payload['name'] = payload['name'].format(rid, sid)
+                
+                await mqtt_discovery(payload)
+                await asyncio.sleep(DISCOVERY_DELAY)
+                
+        return target
+    
+    
+    # MQTT Discovery로 장치 자동 등록
+    async def mqtt_discovery(payload):
+        intg = payload.pop('_intg')
+
+        # MQTT 통합구성요소에 등록되기 위한 추가 내용
+        payload['device'] = DISCOVERY_DEVICE
+        payload['uniq_id'] = payload['name']
+        # 애드온이 중지되면 Last Will로 사용 불가 표시
+        payload['avty_t'] = AVAILABILITY_TOPIC
+        
+        # JSON State 모드는 장치 State Topic에서 속성 값을 Template으로 추출
+        if JSON_STATE:
+            for topic_key, template_key in JSON_STATE_TEMPLATE.items():
+                if topic_key in payload:
+                    state = payload[topic_key].split('/')[1]
+                    payload[topic_key] = '~/state'
+                    payload['stat_val_tpl' if intg == 'light' else template_key] = '{{{{ value_json.{} }}}}'.format(state)
+
+        # Discovery에 등록
+        topic = 'homeassistant/{}/ezville_wallpad/{}/config'.format(intg, payload['name'])
+        log('[INFO] 장치 등록:  {}'.format(topic))
+        mqtt_client.publish(topic, json.dumps(payload))
+        
+        # HA 재시작 시 재등록을 위해 저장
+        DISCOVERY_PUBLISHED.append((topic, json.dumps(payload)))
+
+    
+    # Addon 동작 상태를 MQTT로 Publish
+    async def publish_metric(state, value):
+        await discover_device('bridge', 1, 1)
+        await update_state('bridge', state, 1, 1, value)
+
+    
+    # 장치 State를 MQTT로 Publish
+    async def update_state(device, state, id1, id2, value):
+        target = get_device(device, id1, id2)
+        index = target.index[state]
+        prev_value = target.values[index]
+        
+        if value != prev_value or FORCE_UPDATE:
+            # 값이 바뀐 경우만 이력에 기록
+            if HISTORY is not None and value != prev_value:
+                HISTORY.append(clock(), target.name + state, value)
+                
+            target.values[index] = value
+            
+            # 시작 준비 중에는 State만 보관 (준비가 끝나면 publish_snapshot에서 한번에 Publish)
+            if not ADDON_STARTED:
+                return
+            
+            # 확인 대기 중인 목표값에 도달하면 확인 완료, 아직이면 HA에 반영된 목표값을 유지
+            if target.pending is not None and state in target.pending:
+                if target.pending[state] == value:
+                    del target.pending[state]
+                    if not target.pending:
+                        target.pending = None
+                else:
+                    return
+            
+            # JSON State 모드는 state_update_loop에서 장치별로 모아서 Publish
+            if JSON_STATE:
+                if value != prev_value or target not in FORCE_PUBLISHED:
+                    DIRTY_DEVICES[target] = None
+                return
+            
+            topic = STATE_TOPIC.format(target.name, state)
+            mqtt_client.publish(topic, value.encode())
+                    
+            if mqtt_log:
+                log('[LOG] ->> HA : {} >> {}'.format(topic, value))
+
+        return
+    
+    
+    # Device의 확인된 State에 확인 대기 중인 목표값을 덮어써서 JSON State로 Publish
+    def publish_device_state(target):
+        payload = {state: value for state, value in zip(target.index, target.values) if value is not None}
+        if target.pending is not None:
+            payload.update(target.pending)
+            
+        topic = DEVICE_STATE_TOPIC.format(target.name)
+        mqtt_client.publish(topic, json.dumps(payload))
+        
+        if mqtt_log:
+            log('[LOG] ->> HA : {} >> {}'.format(topic, payload))
+            
+            
+    # 이번 loop에서 State가 바뀐 Device를 장치별 JSON State 하나로 Publish
+    async def flush_device_states():
+        for target in DIRTY_DEVICES:
+            publish_device_state(target)
+            
+            if FORCE_UPDATE:
+                FORCE_PUBLISHED.add(target)
+            
+        DIRTY_DEVICES.clear()
+
+    
+    # 대기전력 전력량을 집계하고 DEADBAND 이상 변하면 바로 Publish
+    async def feed_plug_meter(rid, sid, watt):
+        nonlocal PLUG_METER
+        
+        timestamp = clock()
+        meter = PLUG_METER.get((rid, sid))
+        
+        if meter is None:
+            # 누적 전력량은 Snapshot에 저장된 값부터 이어서 누적
+            meter = {'watt': watt, 'time': timestamp, 'min': watt, 'max': watt, 'sum': 0.0, 'start': timestamp, 'energy': PLUG_ENERGY.pop((rid, sid), 0.0), 'published': None, 'publish_time': 0}
+            PLUG_METER[(rid, sid)] = meter
+        else:
+            integrate_plug_meter(meter, timestamp)
+            meter['watt'] = watt
+            meter['min'] = min(meter['min'], watt)
+            meter['max'] = max(meter['max'], watt)
+            
+        if meter['published'] is None or abs(watt - meter['published']) >= PLUG_DEADBAND or FORCE_UPDATE:
+            await publish_plug_meter(rid, sid, meter, timestamp)
+            
+            
+    # 직전 전력값을 유지했다고 보고 경과 시간만큼 전력량 누적
+    def integrate_plug_meter(meter, timestamp):
+        dt = timestamp - meter['time']
+        
+        meter['sum'] += meter['watt'] * dt
+        meter['energy'] += meter['watt'] * dt / 3600000
+        meter['time'] = timestamp
+        
+        
+    # 현재 전력값 Publish (집계 주기가 지났으면 누적 전력량과 구간 통계도 함께 Publish)
+    async def publish_plug_meter(rid, sid, meter, timestamp):
+        await update_state('plug', 'current', rid, sid, '{:.2f}'.format(meter['watt']))
+        meter['published'] = meter['watt']
+        
+        if timestamp - meter['publish_time'] < PLUG_PUBLISH_INTERVAL and not FORCE_UPDATE:
+            return
+        
+        integrate_plug_meter(meter, timestamp)
+        window = timestamp - meter['start']
+        
+        attributes = {
+            'min': round(meter['min'], 2),
+            'max': round(meter['max'], 2),
+            'mean': round(meter['sum'] / window, 2) if window > 0 else meter['watt'],
+            'window': round(window, 1)
+        }
+        
+        await update_state('plug', 'energy', rid, sid, '{:.3f}'.format(meter['energy']))
+        mqtt_client.publish(ATTRIBUTE_TOPIC.format('plug_{:0>2d}_{:0>2d}'.format(rid, sid), 'current'), json.dumps(attributes))
+        
+        # 다음 집계 구간 시작
+        meter['min'] = meter['max'] = meter['watt']
+        meter['sum'] = 0.0
+        meter['start'] = meter['publish_time'] = timestamp
+        
+        
+    # 전력값 변화가 없어도 집계 주기마다 Publish
+    async def flush_plug_meter():
+        timestamp = clock()
+        
+        for (rid, sid), meter in PLUG_METER.items():
+            if timestamp - meter['publish_time'] >= PLUG_PUBLISH_INTERVAL:
+                await publish_plug_meter(rid, sid, meter, timestamp)
                 
+    
+    # 상태 변경 이력 조회 요청 처리
+    #   요청: {"id": 요청 ID, "key": "gasvalve_01_01power" 또는 "prefix": "thermostat_", "start": 시작 시간, "end": 종료 시간,
+    #          "agg": "transitions" | "count" | "duty" | "stats", "limit": 최대 반환 수, "reply_to": 응답 Topic}
+    #   응답: reply_to 또는 ezville/history/response Topic으로 {"id": 요청 ID, "result": key별 결과}
+    async def history_query(payload):
+        try:
+            request = json.loads(payload)
+            start = float(request.get('start', 0))
+            end = float(request.get('end', clock()))
+            agg = request.get('agg', 'transitions')
+            limit = int(request.get('limit', 1000))
+            reply_to = request.get('reply_to', HISTORY_TOPIC + '/response')
+            
+            if 'key' in request:
+                pattern = request['key']
+                match = lambda key: key == pattern
             else:
-                k+=1
+                pattern = request.get('prefix', '')
+                match = lambda key: key.startswith(pattern)
                 
-    
-    # MQTT Discovery로 장치 자동 등록
-    async def mqtt_discovery(payload):
-        intg = payload.pop('_intg')
-
-        # MQTT 통합구성요소에 등록되기 위한 추가 내용
-        payload['device'] = DISCOVERY_DEVICE
-        payload['uniq_id'] = payload['name']
-
-        # Discovery에 등록
-        topic = 'homeassistant/{}/ezville_wallpad/{}/config'.format(intg, payload['name'])
-        log('[INFO] 장치 등록:  {}'.format(topic))
-        mqtt_client.publish(topic, json.dumps(payload))
-
-    
-    # 장치 State를 MQTT로 Publish
-    async def update_state(device, state, id1, id2, value):
-        nonlocal DEVICE_STATE
-
-        deviceID = '{}_{:0>2d}_{:0>2d}'.format(device, id1, id2)
-        key = deviceID + state
+            # 잘못된 형식의 key/prefix가 이력 집계 중에 오류를 내지 않도록 미리 확인
+            if not isinstance(pattern, str) or not isinstance(reply_to, str):
+                raise TypeError('key, prefix, reply_to는 문자열이어야 합니다')
+        except (ValueError, TypeError, AttributeError) as e:
+            log('[ERROR] 이력 조회 요청 오류: {}'.format(repr(e)))
+            return
+        
+        response = {'id': request.get('id'), 'agg': agg}
         
-        if value != DEVICE_STATE.get(key) or FORCE_UPDATE:
-            DEVICE_STATE[key] = value
+        if HISTORY is None:
+            response['error'] = 'history_store disabled'
+        elif agg not in ('transitions', 'count', 'duty', 'stats'):
+            response['error'] = 'unknown agg'
+        else:
+            # 파일 읽기는 event loop를 막지 않도록 별도 thread에서 실행 (집계 오류는 state_update_loop를 중단시키지 않도록 응답으로 전달)
+            try:
+                response['result'] = await loop.run_in_executor(None, aggregate_history, start, end, agg, limit, match)
+            except Exception as e:
+                log('[ERROR] 이력 조회 오류: {}'.format(repr(e)))
+                response['error'] = repr(e)
             
-            topic = STATE_TOPIC.format(deviceID, state)
-            mqtt_client.publish(topic, value.encode())
-                    
-            if mqtt_log:
-                log('[LOG] ->> HA : {} >> {}'.format(topic, value))
-
-        return
-
+        mqtt_client.publish(reply_to, json.dumps(response))
+        
+        
+    # 이력 구간 집계 (transitions: 변경 이력, count: 변경 횟수, duty: ON/heat 비율, stats: 숫자 값 최소/최대/시간 가중 평균)
+    def aggregate_history(start, end, agg, limit, match):
+        # 아직 파일에 기록되지 않은 최근 변경도 조회되도록 먼저 기록
+        HISTORY.flush()
+        
+        series = {}
+        for timestamp, key, value in HISTORY.query(start, end):
+            if match(key):
+                series.setdefault(key, []).append((timestamp, value))
+                
+        if agg == 'transitions':
+            return {key: points[:limit] for key, points in series.items()}
+        if agg == 'count':
+            return {key: len(points) for key, points in series.items()}
+        
+        # 구간 시작 시점의 값부터 반영
+        for key, (timestamp, value) in HISTORY.last_before(start, match).items():
+            series.setdefault(key, []).insert(0, (start, value))
+            
+        result = {}
+        for key, points in series.items():
+            durations = {}
+            for i, (timestamp, value) in enumerate(points):
+                begin = max(timestamp, start)
+                finish = points[i + 1][0] if i + 1 < len(points) else min(end, clock())
+                durations[value] = durations.get(value, 0) + max(finish - begin, 0)
+            total = sum(durations.values())
+            
+            if agg == 'duty':
+                on_time = sum(duration for value, duration in durations.items() if value in ('ON', 'heat'))
+                result[key] = {'duty': on_time / total if total > 0 else None, 'on': on_time, 'total': total}
+            else:
+                try:
+                    numbers = {float(value): duration for value, duration in durations.items()}
+                except ValueError:
+                    continue
+                result[key] = {
+                    'min': min(numbers),
+                    'max': max(numbers),
+                    'mean': sum(value * duration for value, duration in numbers.items()) / total if total > 0 else None
+                }
+                
+        return result
+        
     
     # HA에서 전달된 메시지 처리        
     async def HA_process(topics, value):
-        nonlocal CMD_QUEUE
-
         device_info = topics[1].split('_')
         device = device_info[0]
         
+        # ezville/<장치>/<속성>/<우선순위>/command 로 전달되면 우선순위 지정, 아니면 장치별 기본값 사용
+        if len(topics) == 5 and topics[3] in COMMAND_PRIORITY:
+            cmd_class = topics[3]
+        else:
+            cmd_class = DEVICE_PRIORITY.get(device, 'interactive')
+        
         if mqtt_log:
             log('[LOG] HA ->> : {} -> {}'.format('/'.join(topics), value))
 
-        if device in RS485_DEVICE:
-            key = topics[1] + topics[2]
+        if device in RS485_DEVICE and topics[2] in PROPERTY_INDEX[device]:
             idx = int(device_info[1])
             sid = int(device_info[2])
-            cur_state = DEVICE_STATE.get(key)
+            target = get_device(device, idx, sid)
+            # 명령 확인용 key (Device, 속성)
+            key = (target, topics[2])
+            statcmd = None
+            # 명령 확인이 늦을 때 보낼 상태 요구 패킷
+            querycmd = state_query(device, idx) if 'query' in RS485_DEVICE[device] else None
+            
+            # 같은 방 묶음에서 전송 대기 중인 명령이 있으면 그 목표값, 확인 대기 중인 명령이 있으면 그 목표값과 비교
+            #   (묶음 안의 명령은 마지막 명령으로 대체되어야 하므로 확인된 값과 같아도 버리지 않음)
+            queued = ROOM_BATCH[(device, idx)]['subcmd'].get(sid) if (device, idx) in ROOM_BATCH else None
+            if queued is not None and queued['statcmd'][0] == key:
+                cur_state = queued['statcmd'][1]
+            elif target.pending is not None and topics[2] in target.pending:
+                cur_state = target.pending[topics[2]]
+            else:
+                cur_state = target.get(topics[2])
             
             if value == cur_state:
                 pass
@@ -649,7 +1529,7 @@ def ezville_loop(config):
                             recvcmd = 'F7' + RS485_DEVICE[device]['power']['id'] + '1' + str(idx) + RS485_DEVICE[device]['power']['ack']
                             statcmd = [key, value]
                            
-                            await CMD_QUEUE.put({'sendcmd': sendcmd, 'recvcmd': recvcmd, 'statcmd': statcmd})
+                            await queue_command({'sendcmd': sendcmd, 'recvcmd': recvcmd, 'statcmd': statcmd, 'querycmd': querycmd}, cmd_class)
                         
                         # Thermostat는 외출 모드를 Off 모드로 연결
                         elif value == 'off':
@@ -658,7 +1538,7 @@ def ezville_loop(config):
                             recvcmd = 'F7' + RS485_DEVICE[device]['away']['id'] + '1' + str(idx) + RS485_DEVICE[device]['away']['ack']
                             statcmd = [key, value]
                            
-                            await CMD_QUEUE.put({'sendcmd': sendcmd, 'recvcmd': recvcmd, 'statcmd': statcmd})
+                            await queue_command({'sendcmd': sendcmd, 'recvcmd': recvcmd, 'statcmd': statcmd, 'querycmd': querycmd}, cmd_class)
                         
 #                        elif value == 'off':
 #                        
@@ -666,7 +1546,7 @@ def ezville_loop(config):
 #                            recvcmd = 'F7' + RS485_DEVICE[device]['power']['id'] + '1' + str(idx) + RS485_DEVICE[device]['power']['ack']
 #                            statcmd = [key, value]
 #                           
-#                            await CMD_QUEUE.put({'sendcmd': sendcmd, 'recvcmd': recvcmd, 'statcmd': statcmd})                    
+#                            await queue_command({'sendcmd': sendcmd, 'recvcmd': recvcmd, 'statcmd': statcmd}, cmd_class)                    
                                                
                         if debug:
                             log('[DEBUG] Queued ::: sendcmd: {}, recvcmd: {}, statcmd: {}'.format(sendcmd, recvcmd, statcmd))
@@ -678,7 +1558,7 @@ def ezville_loop(config):
                         recvcmd = 'F7' + RS485_DEVICE[device]['target']['id'] + '1' + str(idx) + RS485_DEVICE[device]['target']['ack']
                         statcmd = [key, str(value)]
 
-                        await CMD_QUEUE.put({'sendcmd': sendcmd, 'recvcmd': recvcmd, 'statcmd': statcmd})
+                        await queue_command({'sendcmd': sendcmd, 'recvcmd': recvcmd, 'statcmd': statcmd, 'querycmd': querycmd}, cmd_class)
                                
                         if debug:
                             log('[DEBUG] Queued ::: sendcmd: {}, recvcmd: {}, statcmd: {}'.format(sendcmd, recvcmd, statcmd))
@@ -708,7 +1588,7 @@ def ezville_loop(config):
                     recvcmd = 'F7' + RS485_DEVICE[device]['power']['id'] + '1' + str(idx) + RS485_DEVICE[device]['power']['ack']
                     statcmd = [key, value]
                     
-                    await CMD_QUEUE.put({'sendcmd': sendcmd, 'recvcmd': recvcmd, 'statcmd': statcmd})
+                    await queue_room_command(device, idx, sid, stamp_command({'sendcmd': sendcmd, 'recvcmd': recvcmd, 'statcmd': statcmd, 'querycmd': querycmd}, cmd_class))
                                
                     if debug:
                         log('[DEBUG] Queued ::: sendcmd: {}, recvcmd: {}, statcmd: {}'.format(sendcmd, recvcmd, statcmd))
@@ -720,7 +1600,7 @@ def ezville_loop(config):
                     recvcmd = 'F7' + RS485_DEVICE[device]['power']['id'] + '1' + str(idx) + RS485_DEVICE[device]['power']['ack']
                     statcmd = [key, value]
                         
-                    await CMD_QUEUE.put({'sendcmd': sendcmd, 'recvcmd': recvcmd, 'statcmd': statcmd})
+                    await queue_room_command(device, idx, sid, stamp_command({'sendcmd': sendcmd, 'recvcmd': recvcmd, 'statcmd': statcmd, 'querycmd': querycmd}, cmd_class))
                                
                     if debug:
                         log('[DEBUG] Queued ::: sendcmd: {}, recvcmd: {}, statcmd: {}'.format(sendcmd, recvcmd, statcmd))
@@ -732,19 +1612,19 @@ def ezville_loop(config):
                         recvcmd = ['F7' + RS485_DEVICE[device]['power']['id'] + '1' + str(idx) + RS485_DEVICE[device]['power']['ack']]
                         statcmd = [key, value]
 
-                        await CMD_QUEUE.put({'sendcmd': sendcmd, 'recvcmd': recvcmd, 'statcmd': statcmd})
+                        await queue_command({'sendcmd': sendcmd, 'recvcmd': recvcmd, 'statcmd': statcmd, 'querycmd': querycmd}, cmd_class)
                                
                         if debug:
                             log('[DEBUG] Queued ::: sendcmd: {}, recvcmd: {}, statcmd: {}'.format(sendcmd, recvcmd, statcmd))
                                 
                 elif device == 'batch':
                     # Batch는 Elevator 및 외출/그룹 조명 버튼 상태 고려 
-                    elup_state = '1' if DEVICE_STATE.get(topics[1] + 'elevator-up') == 'ON' else '0'
-                    eldown_state = '1' if DEVICE_STATE.get(topics[1] + 'elevator-down') == 'ON' else '0'
-                    out_state = '1' if DEVICE_STATE.get(topics[1] + 'outing') == 'ON' else '0'
-                    group_state = '1' if DEVICE_STATE.get(topics[1] + 'group') == 'ON' else '0'
+                    elup_state = '1' if target.get('elevator-up') == 'ON' else '0'
+                    eldown_state = '1' if target.get('elevator-down') == 'ON' else '0'
+                    out_state = '1' if target.get('outing') == 'ON' else '0'
+                    group_state = '1' if target.get('group') == 'ON' else '0'
 
-                    cur_state = DEVICE_STATE.get(key)
+                    cur_state = target.get(topics[2])
 
                     # 일괄 차단기는 4가지 모드로 조절               
                     if topics[2] == 'elevator-up':
@@ -765,139 +1645,402 @@ def ezville_loop(config):
                     recvcmd = 'NULL'
                     statcmd = [key, 'NULL']
                     
-                    await CMD_QUEUE.put({'sendcmd': sendcmd, 'recvcmd': recvcmd, 'statcmd': statcmd})
+                    await queue_command({'sendcmd': sendcmd, 'recvcmd': recvcmd, 'statcmd': statcmd, 'querycmd': querycmd}, cmd_class)
                     
                     if debug:
                         log('[DEBUG] Queued ::: sendcmd: {}, recvcmd: {}, statcmd: {}'.format(sendcmd, recvcmd, statcmd))
+                        
+                # Optimistic 모드는 명령 실행 전에 목표값을 바로 HA에 반영
+                if OPTIMISTIC_MODE and statcmd is not None and statcmd[1] != 'NULL':
+                    await publish_pending(statcmd[0], statcmd[1])
   
                                                 
+    # 목표값을 확인 대기 상태로 HA에 먼저 Publish (Device.values는 확인된 값만 유지)
+    async def publish_pending(key, value):
+        target, state = key
+        
+        if target.pending is None:
+            target.pending = {}
+        target.pending[state] = value
+        
+        if JSON_STATE:
+            publish_device_state(target)
+            return
+        
+        topic = STATE_TOPIC.format(target.name, state)
+        mqtt_client.publish(topic, value.encode())
+        
+        if mqtt_log:
+            log('[LOG] ->> HA : {} >> {} (확인 대기)'.format(topic, value))
+            
+            
+    # 명령의 목표값이 아직 확인 대기 중이면 삭제 (다른 목표값으로 다시 명령한 경우는 유지)
+    def clear_pending(statcmd):
+        (target, state), value = statcmd
+        
+        if target.pending is None or target.pending.get(state) != value:
+            return False
+        
+        del target.pending[state]
+        if not target.pending:
+            target.pending = None
+            
+        return True
+        
+        
+    # 명령이 실패하면 확인 대기 중인 목표값을 마지막으로 확인된 값으로 되돌림
+    async def rollback_pending(statcmd):
+        (target, state), value = statcmd
+        
+        # 이후 다른 목표값으로 다시 명령한 경우는 그 명령의 결과를 따름
+        if not clear_pending(statcmd):
+            return
+            
+        confirmed = target.get(state)
+        
+        # JSON State 모드는 목표값이 빠진 장치 State 전체를 다시 Publish
+        if JSON_STATE:
+            publish_device_state(target)
+            log('[WARNING] 명령 실패로 상태 복원: {} {} >> {}'.format(DEVICE_STATE_TOPIC.format(target.name), state, confirmed))
+        elif confirmed is not None:
+            topic = STATE_TOPIC.format(target.name, state)
+            mqtt_client.publish(topic, confirmed.encode())
+            log('[WARNING] 명령 실패로 상태 복원: {} >> {}'.format(topic, confirmed))
+        
+        
+    # Command에 우선순위와 유효 시간 기록
+    def stamp_command(send_data, cmd_class):
+        timestamp = clock()
+        
+        send_data['class'] = cmd_class
+        send_data['priority'] = COMMAND_PRIORITY[cmd_class]
+        send_data['queued'] = timestamp
+        send_data['deadline'] = timestamp + CMD_DEADLINE[cmd_class]
+        
+        return send_data
+    
+    
+    # 우선순위 Queue에 Command 추가 (같은 우선순위는 들어온 순서대로 실행)
+    async def queue_command(send_data, cmd_class=None):
+        if cmd_class is not None:
+            stamp_command(send_data, cmd_class)
+        
+        if 'seq' not in send_data:
+            send_data['seq'] = next(CMD_SEQUENCE)
+            
+        heapq.heappush(CMD_QUEUE, (send_data['priority'], send_data['seq'], send_data))
+        
+        
+    # 실행하지 못한 Command 삭제 사유 기록
+    async def drop_command(send_data, reason):
+        nonlocal CMD_DROPPED
+        
+        CMD_DROPPED += 1
+        log('[WARNING] Command 삭제 ({}): {} 우선순위, {:.1f}초 대기, {}'.format(reason, send_data['class'], clock() - send_data['queued'], send_data['statcmd']))
+        
+        await rollback_pending(send_data['statcmd'])
+        await publish_metric('cmdDropped', str(CMD_DROPPED))
+        
+    
+    # 같은 방의 조명/대기전력 명령은 BATCH_WINDOW초 동안 모아서 한번에 처리
+    async def queue_room_command(device, idx, sid, send_data):
+        nonlocal ROOM_BATCH
+        
+        batch = ROOM_BATCH.setdefault((device, idx), {'time': clock(), 'recvcmd': send_data['recvcmd'], 'subcmd': {}})
+        
+        # 같은 sub device에 대한 명령은 마지막 명령만 유지 (대체된 명령의 목표값은 확인 대기에서 삭제)
+        replaced = batch['subcmd'].get(sid)
+        if replaced is not None:
+            clear_pending(replaced['statcmd'])
+            
+        batch['subcmd'][sid] = send_data
+        
+        
+    # BATCH_WINDOW초가 지난 방 단위 명령을 CMD_QUEUE로 이동
+    async def flush_room_batch():
+        nonlocal ROOM_BATCH
+        
+        timestamp = clock()
+        
+        for room in [room for room, batch in ROOM_BATCH.items() if timestamp - batch['time'] >= BATCH_WINDOW]:
+            batch = ROOM_BATCH.pop(room)
+            subcmd = list(batch['subcmd'].values())
+            
+            # 하나뿐인 명령은 기존 형태 그대로 전달
+            if len(subcmd) == 1:
+                await queue_command(subcmd[0])
+            else:
+                # 묶음 명령은 가장 높은 우선순위와 가장 늦은 유효 시간을 따르고, 만료는 sub device별로 처리
+                await queue_command({
+                    'recvcmd': batch['recvcmd'],
+                    'subcmd': subcmd,
+                    'priority': min(sub['priority'] for sub in subcmd),
+                    'deadline': max(sub['deadline'] for sub in subcmd)
+                })
+                
+                if debug:
+                    log('[DEBUG] Batched ::: {} {}번 방 명령 {}개'.format(room[0], room[1], len(subcmd)))
+            
+            
+    # EW11으로 패킷 전송 (여러 패킷은 이어 붙여서 한번에 전송)
+    async def send_packet(sendcmd):
+        if comm_mode == 'failover':
+            # socket 전송이 실패하면 바로 MQTT 경로로 전환 (socket 재연결은 serial_recv_loop에서 진행)
+            if ACTIVE_PATH == 'socket':
+                try:
+                    await loop.sock_sendall(soc, bytes.fromhex(sendcmd))
+                    return
+                except (OSError, AttributeError) as e:
+                    switch_path('mqtt', 'socket 전송 실패, ' + repr(e))
+                    
+            mqtt_client.publish(EW11_SEND_TOPIC, bytes.fromhex(sendcmd))
+        elif comm_mode == 'mqtt':
+            mqtt_client.publish(EW11_SEND_TOPIC, bytes.fromhex(sendcmd))
+        else:
+            try:
+                await loop.sock_sendall(soc, bytes.fromhex(sendcmd))
+            except OSError:
+                await reconnect_socket(soc)
+                await loop.sock_sendall(soc, bytes.fromhex(sendcmd))
+                    
+                    
+    # 확인되지 않은 명령의 상태 요구 패킷 전송 (같은 패킷은 STATE_QUERY_INTERVAL초에 한번만 보내서 Bus 부하 제한)
+    async def send_state_query(pending):
+        timestamp = clock()
+        querycmd = []
+        
+        for sub in pending:
+            query = sub.get('querycmd')
+            
+            if query is None or query in querycmd or timestamp - QUERY_SENT.get(query, 0) < STATE_QUERY_INTERVAL:
+                continue
+                
+            QUERY_SENT[query] = timestamp
+            querycmd.append(query)
+            
+        if querycmd:
+            if ew11_log:
+                log('[SIGNAL] 상태 요구 전송: {}'.format(querycmd))
+                
+            await send_packet(''.join(querycmd))
+            
+            
+    # 확인되지 않은 명령만 반환 (Bus State가 이미 목표값이면 update_state에서 확인되지 않으므로 여기서 확인 대기 삭제)
+    def unconfirmed(pending):
+        result = []
+        
+        for sub in pending:
+            if sub['statcmd'][1] == current_state(sub['statcmd'][0]):
+                clear_pending(sub['statcmd'])
+            else:
+                result.append(sub)
+                
+        return result
+        
+        
+    # 명령 확인용 key (Device, 속성)의 현재 State
+    def current_state(key):
+        target, state = key
+        return target.get(state)
+        
+        
     # HA에서 전달된 명령을 EW11 패킷으로 전송
     async def send_to_ew11(send_data):
+        # 방 단위로 묶인 명령은 sub device별로 완료 여부를 확인
+        pending = send_data.get('subcmd', [send_data])
+            
+        # 우선순위에 밀려 다시 Queue에 들어갔던 명령은 이전 재시도 횟수부터 진행
+        for i in range(send_data.get('count', 0), CMD_RETRY_COUNT):
+            # 유효 시간이 지난 명령은 전송하지 않고 삭제
+            timestamp = clock()
+            for sub in [sub for sub in pending if timestamp > sub['deadline']]:
+                await drop_command(sub, '유효 시간 초과' if i == 0 else '재시도 중 유효 시간 초과')
+            pending = [sub for sub in pending if timestamp <= sub['deadline']]
+            
+            if not pending:
+                return
             
-        for i in range(CMD_RETRY_COUNT):
             if ew11_log:
                 log('[SIGNAL] 신호 전송: {}'.format(send_data))
-                        
-            if comm_mode == 'mqtt':
-                mqtt_client.publish(EW11_SEND_TOPIC, bytes.fromhex(send_data['sendcmd']))
-            else:
-                nonlocal soc
-                try:
-                    soc.sendall(bytes.fromhex(send_data['sendcmd']))
-                except OSError:
-                    soc.close()
-                    soc = initiate_socket(soc)
-                    soc.sendall(bytes.fromhex(send_data['sendcmd']))
-            if debug:                     
-                log('[DEBUG] Iter. No.: ' + str(i + 1) + ', Target: ' + send_data['statcmd'][1] + ', Current: ' + DEVICE_STATE.get(send_data['statcmd'][0]))
+            
+            # 전송 오류는 재시도로 처리 (command_loop가 중단되지 않도록 여기서 처리)
+            try:
+                await send_packet(''.join(sub['sendcmd'] for sub in pending))
+            except (OSError, AttributeError) as e:
+                log('[ERROR] 명령 전송 실패, 재시도 예정 ({})'.format(repr(e)))
+            
+            if debug:
+                for sub in pending:
+                    log('[DEBUG] Iter. No.: ' + str(i + 1) + ', Target: ' + sub['statcmd'][1] + ', Current: ' + str(current_state(sub['statcmd'][0])))
              
             # Ack나 State 업데이트가 불가한 경우 한번만 명령 전송 후 Return
-            if send_data['statcmd'][1] == 'NULL':
+            if any(sub['statcmd'][1] == 'NULL' for sub in pending):
                 return
       
             # FIRST_WAITTIME초는 ACK 처리를 기다림 (초당 30번 데이터가 들어오므로 ACK 못 받으면 후속 처리 시작)
             if i == 0:
-                await asyncio.sleep(FIRST_WAITTIME)
+                wait = FIRST_WAITTIME
             # 이후에는 정해진 간격 혹은 Random Backoff 시간 간격을 주고 ACK 확인
             else:
                 if RANDOM_BACKOFF:
-                    await asyncio.sleep(random.randint(0, int(CMD_INTERVAL * 1000))/1000)    
+                    wait = random.randint(0, int(CMD_INTERVAL * 1000))/1000
                 else:
-                    await asyncio.sleep(CMD_INTERVAL)
+                    wait = CMD_INTERVAL
+                    
+            # STATE_QUERY_DELAY초 안에 확인되지 않으면 상태 요구 패킷을 보내서 월패드 Polling 주기를 기다리지 않음
+            if STATE_QUERY and wait > STATE_QUERY_DELAY:
+                await asyncio.sleep(STATE_QUERY_DELAY)
+                
+                pending = unconfirmed(pending)
+                if not pending:
+                    return
+                
+                await send_state_query(pending)
+                wait -= STATE_QUERY_DELAY
+                
+            await asyncio.sleep(wait)
               
-            if send_data['statcmd'][1] == DEVICE_STATE.get(send_data['statcmd'][0]):
+            # 방 State 패킷으로 확인된 sub device는 재전송 대상에서 제외
+            pending = unconfirmed(pending)
+            
+            if not pending:
+                return
+            
+            # 재시도 중에도 모으는 시간이 지난 방 단위 명령은 CMD_QUEUE로 옮겨서 우선순위 비교에 포함
+            await flush_room_batch()
+            
+            # 더 높은 우선순위의 명령이 기다리면 남은 명령은 Queue에 다시 넣고 양보
+            if CMD_QUEUE and CMD_QUEUE[0][0] < send_data['priority']:
+                send_data['count'] = i + 1
+                if 'subcmd' in send_data:
+                    send_data['subcmd'] = pending
+                await queue_command(send_data)
                 return
 
+        for sub in pending:
+            await rollback_pending(sub['statcmd'])
+            
         if ew11_log:
             log('[SIGNAL] {}회 명령을 재전송하였으나 수행에 실패했습니다.. 다음의 Queue 삭제: {}'.format(str(CMD_RETRY_COUNT),send_data))
             return
         
                                                 
     # EW11 동작 상태를 체크해서 필요시 리셋 실시
-    async def ew11_health_loop():        
+    async def ew11_health_loop():
+        nonlocal reset_task
+        nonlocal last_received_time
+        
         while True:
-            timestamp = time.time()
+            timestamp = clock()
+            
+            # EW11 패킷을 MQTT로만 받는 경우 MQTT 연결이 끊어진 동안은 EW11 문제가 아니므로 대기 시간을 다시 시작
+            if (comm_mode == 'mqtt' or comm_mode == 'mixed') and not MQTT_CONNECTED.is_set():
+                last_received_time = timestamp
+                
+                if debug:
+                    log('[DEBUG] MQTT 연결 해제 중이므로 EW11 상태 체크 보류')
         
-            # TIMEOUT 시간 동안 새로 받은 EW11 패킷이 없으면 재시작
+            # TIMEOUT 시간 동안 새로 받은 EW11 패킷이 없으면 재시작 (이미 리셋 중이면 대기)
             if timestamp - last_received_time > EW11_TIMEOUT:
-                log('[WARNING] {} {} {}초간 신호를 받지 못했습니다. ew11 기기를 재시작합니다.'.format(timestamp, last_received_time, EW11_TIMEOUT))
-                try:
-                    await reset_EW11()
-                    
-                    restart_flag = True
-
-                except:
-                    log('[ERROR] 기기 재시작 오류! 기기 상태를 확인하세요.')
-            else:
-                log('[INFO] EW11 연결 상태 문제 없음')
-            await asyncio.sleep(EW11_TIMEOUT)        
+                if reset_task is None or reset_task.done():
+                    log('[WARNING] {} {} {}초간 신호를 받지 못했습니다. ew11 기기를 재시작합니다.'.format(timestamp, last_received_time, EW11_TIMEOUT))
+                    reset_task = asyncio.get_event_loop().create_task(reset_EW11())
+            elif debug:
+                log('[DEBUG] EW11 연결 상태 문제 없음')
+                
+            await asyncio.sleep(EW11_HEALTH_CHECK_DELAY)
 
                                                 
     # Telnet 접속하여 EW11 리셋        
     async def reset_EW11(): 
+        nonlocal restart_flag
+        
         ew11_id = config['ew11_id']
         ew11_password = config['ew11_password']
         ew11_server = config['ew11_server']
 
-        ew11 = telnetlib.Telnet(ew11_server)
-
-        ew11.read_until(b'login:')
-        ew11.write(ew11_id.encode('utf-8') + b'\n')
-        ew11.read_until(b'password:')
-        ew11.write(ew11_password.encode('utf-8') + b'\n')
-        ew11.write('Restart'.encode('utf-8') + b'\n')
-        ew11.read_until(b'Restart..')
+        ew11 = telnet(ew11_server, timeout=EW11_RESET_TIMEOUT)
+        
+        try:
+            await ew11.connect()
+            
+            await ew11.read_until(b'login:')
+            await ew11.write(ew11_id.encode('utf-8') + b'\n')
+            await ew11.read_until(b'password:')
+            await ew11.write(ew11_password.encode('utf-8') + b'\n')
+            await ew11.write('Restart'.encode('utf-8') + b'\n')
+            await ew11.read_until(b'Restart..')
+        except (asyncio.TimeoutError, OSError) as e:
+            log('[ERROR] 기기 재시작 오류! 기기 상태를 확인하세요. ({})'.format(repr(e)))
+            return
+        finally:
+            ew11.close()
         
         log('[INFO] EW11 리셋 완료')
+        restart_flag = True
         
-        # 리셋 후 60초간 Delay
+        # 리셋 후 60초간 재시작 대기 (health loop는 이 task가 끝날 때까지 리셋하지 않음)
         await asyncio.sleep(60)
         
     
-    def initiate_socket():
+    async def initiate_socket():
         # SOCKET 통신 시작
         log('[INFO] Socket 연결을 시작합니다')
             
         retry_count = 0
         while True:
+            soc = socket.socket()
+            soc.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            soc.setblocking(False)
             try:
-                soc = socket.socket()
-                soc.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
-                connect_socket(soc)
+                await asyncio.wait_for(loop.sock_connect(soc, (SOC_ADDRESS, SOC_PORT)), EW11_RESET_TIMEOUT)
                 return soc
-            except ConnectionRefusedError as e:
-                log('[ERROR] Server에서 연결을 거부합니다. 재시도 예정 (' + str(retry_count) + '회 재시도)')
-                time.sleep(1)
+            except (OSError, asyncio.TimeoutError) as e:
+                soc.close()
+                log('[ERROR] Socket 연결에 실패했습니다. 재시도 예정 (' + str(retry_count) + '회 재시도, ' + repr(e) + ')')
+                await asyncio.sleep(1)
                 retry_count += 1
                 continue
              
-            
-    def connect_socket(socket):
-        socket.connect((SOC_ADDRESS, SOC_PORT))
     
-
-    async def serial_recv_loop():
+    # Socket 재연결 (여러 task에서 동시에 요청해도 한번만 재연결)
+    async def reconnect_socket(old_soc):
         nonlocal soc
-        nonlocal MSG_QUEUE
-        
-        class MSG:
-            topic = ''
-            payload = bytearray()
-        
-        msg = MSG()
         
+        async with socket_lock:
+            # 다른 task에서 이미 재연결한 경우
+            if soc is not old_soc:
+                return
+            
+            # 새 socket이 연결될 때까지 닫힌 socket을 유지 (그 사이 전송은 OSError로 재연결을 기다림)
+            if soc is not None:
+                soc.close()
+            RESIDUE.pop('socket', None)
+            soc = await initiate_socket()
+            
+
+    async def serial_recv_loop():
         while True:
+            cur_soc = soc
+            
+            # Failover 모드는 socket 연결 없이 시작하므로 여기서 연결
+            if cur_soc is None:
+                await reconnect_socket(cur_soc)
+                continue
+                
             try:
-                # EW11 버퍼 크기만큼 데이터 받기
-                DATA = soc.recv(EW11_BUFFER_SIZE)
-                msg.topic = EW11_TOPIC + '/recv'
-                msg.payload = DATA   
+                # EW11 버퍼 크기만큼 데이터 받기 (EW11_TIMEOUT초간 데이터가 없으면 재연결)
+                DATA = await asyncio.wait_for(loop.sock_recv(cur_soc, EW11_BUFFER_SIZE), EW11_TIMEOUT)
                 
-                MSG_QUEUE.put(msg)
+                # 연결이 종료된 경우
+                if not DATA:
+                    raise ConnectionResetError('Socket 연결 종료')
                 
-            except OSError:
-                soc.close()
-                soc = initiate_socket(soc)
+                queue_bus_data(DATA, 'socket')
+                
+            except (OSError, asyncio.TimeoutError) as e:
+                log('[WARNING] Socket 수신 오류로 재연결합니다 ({})'.format(repr(e)))
+                await reconnect_socket(cur_soc)
          
             await asyncio.sleep(SERIAL_RECV_DELAY) 
         
@@ -906,20 +2049,30 @@ def ezville_loop(config):
         nonlocal force_target_time
         nonlocal force_stop_time
         nonlocal FORCE_UPDATE
+        nonlocal FORCE_REQUEST
         
         while True:
             await process_message()                    
+            await flush_plug_meter()
+            
+            if comm_mode == 'failover':
+                await check_transport()
+                
+            if JSON_STATE:
+                await flush_device_states()
             
-            timestamp = time.time()
+            timestamp = clock()
             
-            # 정해진 시간이 지나면 FORCE 모드 발동
-            if timestamp > force_target_time and not FORCE_UPDATE and FORCE_MODE:
+            # 정해진 시간이 지나거나 통신 복구 후 요청이 있으면 FORCE 모드 발동
+            if ((timestamp > force_target_time and FORCE_MODE) or FORCE_REQUEST) and not FORCE_UPDATE:
                 force_stop_time = timestamp + FORCE_DURATION
                 FORCE_UPDATE = True
+                FORCE_REQUEST = False
+                FORCE_PUBLISHED.clear()
                 log('[INFO] 상태 강제 업데이트 실시')
                 
             # 정해진 시간이 지나면 FORCE 모드 종료    
-            if timestamp > force_stop_time and FORCE_UPDATE and FORCE_MODE:
+            if timestamp > force_stop_time and FORCE_UPDATE:
                 force_target_time = timestamp + FORCE_PERIOD
                 FORCE_UPDATE = False
                 log('[INFO] 상태 강제 업데이트 종료')
@@ -929,117 +2082,259 @@ def ezville_loop(config):
             
             
     async def command_loop():
-        nonlocal CMD_QUEUE
-        
         while True:
-            if not CMD_QUEUE.empty():
-                send_data = await CMD_QUEUE.get()
+            await flush_room_batch()
+            
+            # 가장 높은 우선순위의 명령부터 실행
+            if CMD_QUEUE:
+                priority, seq, send_data = heapq.heappop(CMD_QUEUE)
                 await send_to_ew11(send_data)               
             
             # COMMAND_LOOP_DELAY 초 대기 후 루프 진행
             await asyncio.sleep(COMMAND_LOOP_DELAY)    
  
 
-    # EW11 재실행 시 리스타트 실시
+    # 통신 장애 시 State, Cache, Queue를 유지한 채 각 통신만 복구
     async def restart_control():
-        nonlocal mqtt_client
         nonlocal restart_flag
-        nonlocal MQTT_ONLINE
+        nonlocal mqtt_recovery_time
+        nonlocal ew11_recovery_start
+        nonlocal rediscovery_time
+        nonlocal FORCE_REQUEST
         
         while True:
-            if restart_flag or (not MQTT_ONLINE and ADDON_STARTED and REBOOT_CONTROL):
-                if restart_flag:
-                    log('[WARNING] EW11 재시작 확인')
-                elif not MQTT_ONLINE and ADDON_STARTED and REBOOT_CONTROL:
-                    log('[WARNING] 동작 중 MQTT Integration Offline 변경')
+            # EW11 재시작 시 Socket만 재연결하고 첫 패킷 수신까지 시간 측정
+            if restart_flag:
+                log('[WARNING] EW11 재시작 확인')
+                restart_flag = False
+                ew11_recovery_start = clock()
+                RESIDUE.clear()
                 
-                # Asyncio Loop 획득
-                loop = asyncio.get_event_loop()
+                if comm_mode == 'mixed' or comm_mode == 'socket' or comm_mode == 'failover':
+                    await reconnect_socket(soc)
+                    
+            if ew11_recovery_start is not None and last_received_time > ew11_recovery_start:
+                recovery = last_received_time - ew11_recovery_start
+                ew11_recovery_start = None
+                log('[INFO] EW11 통신 복구 완료 ({:.2f}초)'.format(recovery))
                 
-                # MTTQ 및 socket 연결 종료
-                log('[WARNING] 모든 통신 종료')
-                mqtt_client.loop_stop()
-                if comm_mode == 'mixed' or comm_mode == 'socket':
-                    nonlocal soc
-                    soc.close()
-                       
-                # flag 원복
-                restart_flag = False
-                MQTT_ONLINE = False
-
-                # asyncio loop 종료
-                log('[WARNING] asyncio loop 종료')
-                loop.stop()
+                await publish_metric('ew11Recovery', '{:.2f}'.format(recovery))
+                
+            # MQTT 재연결 시 연결 해제 중 놓친 State를 강제 업데이트로 다시 전달
+            if mqtt_recovery_time is not None:
+                recovery = mqtt_recovery_time
+                mqtt_recovery_time = None
+                log('[INFO] MQTT 통신 복구 완료 ({:.2f}초)'.format(recovery))
+                
+                FORCE_REQUEST = True
+                await publish_metric('mqttRecovery', '{:.2f}'.format(recovery))
+                
+            # HA 재시작 시 저장된 Discovery 메시지로 장치 재등록 후 강제 업데이트
+            if rediscovery_time is not None and clock() > rediscovery_time:
+                rediscovery_time = None
+                log('[INFO] MQTT Integration 재시작 확인. 장치를 다시 등록합니다')
+                
+                for topic, payload in DISCOVERY_PUBLISHED:
+                    mqtt_client.publish(topic, payload)
+                    await asyncio.sleep(DISCOVERY_DELAY)
+                    
+                FORCE_REQUEST = True
+                recovery = clock() - ha_online_time
+                log('[INFO] MQTT Integration 복구 완료 ({:.2f}초)'.format(recovery))
+                
+                await publish_metric('haRecovery', '{:.2f}'.format(recovery))
             
             # RESTART_CHECK_DELAY초 마다 실행
             await asyncio.sleep(RESTART_CHECK_DELAY)
+            
+            
+    # 시작 단계별 완료 시간 기록
+    async def startup_phase(name, start, coro):
+        await coro
+        log('[INFO] 시작 단계 완료: {} ({:.2f}초)'.format(name, clock() - start))
+        
+        
+    # Socket 연결 (socket 모드는 연결되면 바로 수신 시작)
+    async def connect_socket():
+        nonlocal soc
+        
+        soc = await initiate_socket()
+        
+        if comm_mode == 'socket':
+            loop.create_task(serial_recv_loop())
+            
+            
+    # MQTT Integration의 Birth/Last Will Testament 확인 후 필요시 Discovery 등의 지연을 위해 Delay 부여
+    async def wait_ha():
+        if REBOOT_CONTROL:
+            await HA_ONLINE.wait()
+            
+        await asyncio.sleep(startup_delay)
+        
+        
+    def read_snapshot():
+        with open(SNAPSHOT_FILE) as file:
+            return json.load(file)
+        
+        
+    def write_snapshot(snapshot):
+        with open(SNAPSHOT_FILE + '.tmp', 'w') as file:
+            file.write(snapshot)
+        os.replace(SNAPSHOT_FILE + '.tmp', SNAPSHOT_FILE)
+        
+        
+    # 저장된 Device State와 누적 전력량 읽기 (시작 준비 중에 이미 패킷으로 받은 값은 유지)
+    async def load_snapshot():
+        try:
+            snapshot = await loop.run_in_executor(None, read_snapshot)
+            
+            for device, rid, sid, values in snapshot['devices']:
+                if device not in RS485_DEVICE or len(values) != len(DEVICE_PROPERTY[device]):
+                    continue
+                
+                target = get_device(device, rid, sid)
+                target.values = [value if value is not None else saved for value, saved in zip(target.values, values)]
+                
+            for rid, sid, energy in snapshot['plug_energy']:
+                if (rid, sid) in PLUG_METER:
+                    PLUG_METER[(rid, sid)]['energy'] += energy
+                else:
+                    PLUG_ENERGY[(rid, sid)] = energy
+        except FileNotFoundError:
+            log('[INFO] 저장된 Snapshot이 없습니다')
+        except (OSError, ValueError, TypeError, KeyError) as e:
+            log('[WARNING] Snapshot을 읽지 못했습니다 ({})'.format(repr(e)))
+            
+            
+    # Device State와 누적 전력량 저장 (파일 쓰기는 event loop를 막지 않도록 별도 thread에서 실행)
+    async def save_snapshot():
+        snapshot = json.dumps({
+            'devices': [[device, rid, sid, target.values] for (device, rid, sid), target in DEVICES.items() if device in RS485_DEVICE],
+            'plug_energy': [[rid, sid, meter['energy']] for (rid, sid), meter in PLUG_METER.items()]
+        })
+        
+        try:
+            await loop.run_in_executor(None, write_snapshot, snapshot)
+        except OSError as e:
+            log('[WARNING] Snapshot을 저장하지 못했습니다 ({})'.format(repr(e)))
+            
+            
+    # 상태 변경 이력을 주기적으로 파일에 기록 (SD 카드 용량 부족 등으로 기록하지 못하면 이력 저장 중단)
+    async def history_flush_loop():
+        nonlocal HISTORY
+        
+        while HISTORY is not None:
+            await asyncio.sleep(HISTORY_FLUSH_INTERVAL)
+            
+            try:
+                await loop.run_in_executor(None, HISTORY.flush)
+            except OSError as e:
+                log('[WARNING] 상태 변경 이력을 저장하지 못해 이력 저장을 중단합니다 ({})'.format(repr(e)))
+                
+                try:
+                    HISTORY.close()
+                except OSError:
+                    pass
+                HISTORY = None
+                
+                
+    async def snapshot_loop():
+        while True:
+            await asyncio.sleep(SNAPSHOT_INTERVAL)
+            await save_snapshot()
+            
+            
+    # 시작 준비 중에 받은 State와 Snapshot State로 장치 등록 후 Publish
+    async def publish_snapshot():
+        for (device, rid, sid), target in list(DEVICES.items()):
+            await discover_device(device, rid, sid)
+            
+            if JSON_STATE:
+                DIRTY_DEVICES[target] = None
+                continue
+            
+            for state, value in zip(target.index, target.values):
+                if target.pending is not None:
+                    value = target.pending.get(state, value)
+                    
+                if value is not None:
+                    mqtt_client.publish(STATE_TOPIC.format(target.name, state), value.encode())
+                    
+                    
+    # MQTT 연결, socket 연결, Snapshot 읽기를 동시에 진행하고 HA가 준비되면 장치 등록 후 online Publish
+    #   state_update_loop는 먼저 실행되어 준비 중에 받은 패킷도 State로 보관
+    async def startup():
+        nonlocal ADDON_STARTED
+        nonlocal last_received_time
+        
+        start = clock()
+        log('[INFO] MQTT 연결, EW11 연결, Snapshot 읽기를 시작합니다')
+        
+        loop.create_task(startup_phase('첫 EW11 패킷 수신', start, BUS_RECEIVED.wait()))
+        
+        phases = [startup_phase('MQTT 연결', start, MQTT_CONNECTED.wait())]
+        if comm_mode == 'mixed' or comm_mode == 'socket':
+            phases.append(startup_phase('EW11 socket 연결', start, connect_socket()))
+        if SNAPSHOT_STORE:
+            phases.append(startup_phase('Snapshot 읽기', start, load_snapshot()))
+            
+        await asyncio.gather(*phases)
+        
+        # Home Assistant 명령 실행 loop 실행
+        loop.create_task(command_loop())
+        # EW11 상태 체크 loop 실행 (연결 대기 시간은 수신 지연으로 보지 않음)
+        last_received_time = clock()
+        loop.create_task(ew11_health_loop())
+        
+        await startup_phase('MQTT Integration 대기', start, wait_ha())
+        
+        # ADDON 정상 시작 Flag 설정 후 보관 중인 State를 HA에 등록
+        ADDON_STARTED = True
+        log('[INFO] 장치 등록 및 상태 업데이트를 시작합니다')
+        
+        await startup_phase('장치 등록', start, publish_snapshot())
+        mqtt_client.publish(AVAILABILITY_TOPIC, 'online', retain=True)
+        
+        if SNAPSHOT_STORE:
+            loop.create_task(snapshot_loop())
 
         
-    # MQTT 통신
-    from paho.mqtt.enums import CallbackAPIVersion
-    mqtt_client = mqtt.Client(CallbackAPIVersion.VERSION1, 'mqtt-ezville')
+    # MQTT 통신 (외부에서 Client를 전달하지 않으면 paho Client 생성)
+    if mqtt_client is None:
+        from paho.mqtt.enums import CallbackAPIVersion
+        mqtt_client = mqtt.Client(CallbackAPIVersion.VERSION1, 'mqtt-ezville')
     mqtt_client.username_pw_set(config['mqtt_id'], config['mqtt_password'])
     mqtt_client.on_connect = on_connect
     mqtt_client.on_disconnect = on_disconnect
     mqtt_client.on_message = on_message
+    mqtt_client.will_set(AVAILABILITY_TOPIC, 'offline', retain=True)
     mqtt_client.connect_async(config['mqtt_server'])
     
     # asyncio loop 획득 및 EW11 오류시 재시작 task 등록
-    loop = asyncio.get_event_loop()
+    if loop is None:
+        loop = asyncio.get_event_loop()
     loop.create_task(restart_control())
         
     # Discovery 및 강제 업데이트 시간 설정
-    force_target_time = time.time() + FORCE_PERIOD
+    force_target_time = clock() + FORCE_PERIOD
     force_stop_time = force_target_time + FORCE_DURATION
     
 
-    while True:
-        # MQTT 통신 시작
-        mqtt_client.loop_start()
-        # MQTT Integration의 Birth/Last Will Testament를 기다림 (1초 단위)
-        while not MQTT_ONLINE and REBOOT_CONTROL:
-            log('[INFO] Waiting for MQTT connection')
-            time.sleep(1)
-        
-        # socket 통신 시작       
-        if comm_mode == 'mixed' or comm_mode == 'socket':
-            soc = initiate_socket()  
-
-        log('[INFO] 장치 등록 및 상태 업데이트를 시작합니다')
-
-        tasklist = []
- 
-        # 필요시 Discovery 등의 지연을 위해 Delay 부여 
-        time.sleep(startup_delay)      
-  
-        # socket 데이터 수신 loop 실행
-        if comm_mode == 'socket':
-            tasklist.append(loop.create_task(serial_recv_loop()))
-        # EW11 패킷 기반 state 업데이트 loop 실행
-        tasklist.append(loop.create_task(state_update_loop()))
-        # Home Assistant 명령 실행 loop 실행
-        tasklist.append(loop.create_task(command_loop()))
-        # EW11 상태 체크 loop 실행
-        tasklist.append(loop.create_task(ew11_health_loop()))
-        
-        # ADDON 정상 시작 Flag 설정
-        ADDON_STARTED = True
-        loop.run_forever()
-        
-        # 이전 task는 취소
-        log('[INFO] 이전 실행 Task 종료')
-        for task in tasklist:
-            task.cancel()
-
-        ADDON_STARTED = False
-        
-        # 주요 변수 초기화    
-        MSG_QUEUE = Queue()
-        CMD_QUEUE = asyncio.Queue()
-        DEVICE_STATE = {}
-        MSG_CACHE = {}
-        DISCOVERY_LIST = []
-        RESIDUE = ''
+    # MQTT 통신 시작 (연결이 끊어지면 paho loop가 자동으로 재연결)
+    mqtt_client.loop_start()
+    
+    # EW11 패킷 기반 state 업데이트 loop 실행 (시작 준비 중에도 State 보관)
+    loop.create_task(state_update_loop())
+    # 상태 변경 이력 기록 loop 실행
+    if HISTORY is not None:
+        loop.create_task(history_flush_loop())
+    # Failover 모드는 socket 연결도 serial_recv_loop에서 진행 (socket 모드는 연결 후 startup에서 실행)
+    if comm_mode == 'failover':
+        loop.create_task(serial_recv_loop())
+    # 연결 및 시작 준비 task 실행
+    loop.create_task(startup())
+    
+    loop.run_forever()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,522 @@
+#!/usr/bin/env python3
+# ezville_loop 가상 시간 실행 도구
+#   - asyncio loop의 시간을 가상 시간으로 바꿔서 대기할 일이 없으면 다음 예약 시간까지 바로 진행
+#   - 가짜 MQTT Broker, 월패드 (EW11), Telnet으로 ezville_loop의 task를 그대로 실행
+#   - 재시도 30회, 600초 강제 업데이트, 3600초 Health Check 같은 시나리오를 수 ms 안에 확인
+#
+# 사용법: python harness.py [시나리오 ...] [--verbose]
+
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import os
+import random
+import selectors
+import sys
+import time
+
+import ezville
+from ezville import checksum, RS485_DEVICE, EW11_TOPIC, EW11_SEND_TOPIC, STATE_TOPIC, AVAILABILITY_TOPIC
+
+
+# 가상 시간의 시작 시각 (clock()이 돌려주는 epoch 기준 시간)
+EPOCH = 1700000000.0
+
+
+# 준비된 I/O가 없으면 요청받은 timeout만큼 가상 시간을 진행하는 Selector
+class VirtualSelector(selectors.DefaultSelector):
+    def __init__(self):
+        super().__init__()
+        self.now = 0.0
+
+    def select(self, timeout=None):
+        events = super().select(0)
+
+        if not events and timeout:
+            self.now += timeout
+
+        return events
+
+
+# run_in_executor 작업을 thread 대신 바로 실행 (thread가 끝나기 전에 가상 시간이 진행되지 않도록)
+class InlineExecutor(concurrent.futures.ThreadPoolExecutor):
+    def submit(self, fn, *args, **kwargs):
+        future = concurrent.futures.Future()
+
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+
+        return future
+
+
+# 가상 시간으로 동작하는 asyncio loop
+class VirtualClockLoop(asyncio.SelectorEventLoop):
+    def __init__(self):
+        self.selector = VirtualSelector()
+        super().__init__(self.selector)
+        self.set_default_executor(InlineExecutor())
+
+    def time(self):
+        return self.selector.now
+
+    # ezville_loop의 time.time() 대신 사용
+    def clock(self):
+        return EPOCH + self.selector.now
+
+
+class FakeMessage:
+    def __init__(self, topic, payload, retain=False):
+        self.topic = topic
+        self.payload = payload
+        self.retain = retain
+
+
+# paho Client 대신 사용하는 가짜 MQTT Client (Publish는 기록하고 EW11 전송 Topic은 월패드로 전달)
+class FakeMQTT:
+    def __init__(self, loop):
+        self.loop = loop
+        self.published = []
+        self.subscriptions = []
+        self.wallpad = None
+        self.connected = True
+        self.on_connect = None
+        self.on_disconnect = None
+        self.on_message = None
+
+    def username_pw_set(self, username, password=None):
+        pass
+
+    def will_set(self, topic, payload=None, qos=0, retain=False):
+        pass
+
+    def connect_async(self, host, port=1883, keepalive=60):
+        pass
+
+    def loop_start(self):
+        self.on_connect(self, None, {}, 0)
+
+    def subscribe(self, topic, qos=0):
+        self.subscriptions.append(topic)
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.published.append((self.loop.time(), topic, payload))
+
+        if topic == EW11_SEND_TOPIC and self.wallpad is not None:
+            self.wallpad.receive(payload)
+
+    # Broker에서 메시지가 도착한 것처럼 on_message 호출
+    def deliver(self, topic, payload, retain=False):
+        if not self.connected:
+            return
+        if isinstance(payload, str):
+            payload = payload.encode()
+        self.on_message(self, None, FakeMessage(topic, payload, retain))
+
+    # 연결이 끊어졌다가 delay초 후 재연결
+    def drop_connection(self, delay):
+        self.connected = False
+        self.on_disconnect(self, None, 1)
+        self.loop.call_later(delay, self.reconnect)
+
+    def reconnect(self):
+        self.connected = True
+        self.on_connect(self, None, {}, 0)
+
+    # 특정 Topic에 Publish된 (가상 시간, payload) 목록
+    def history(self, topic):
+        return [(timestamp, payload) for timestamp, t, payload in self.published if t == topic]
+
+
+# 조명만 있는 가짜 월패드 (EW11 MQTT 및 socket으로 State 패킷을 주기적으로 보내고 명령에는 ACK로 응답)
+class FakeWallpad:
+    LIGHT = RS485_DEVICE['light']
+
+    def __init__(self, mqtt_client, loop, rooms={1: 3}, poll_interval=0.2, ack_delay=0.05):
+        self.mqtt = mqtt_client
+        self.loop = loop
+        self.lights = {room: [0] * count for room, count in rooms.items()}
+        self.poll_interval = poll_interval
+        self.ack_delay = ack_delay
+
+        # 시나리오 제어용: 명령 무시, ACK 없이 명령만 수행, 전체 응답 중단, 경로별 송신 여부
+        self.ignore_commands = False
+        self.drop_acks = False
+        self.silent = False
+        self.paths = {'mqtt': True, 'socket': True}
+
+        # socket 연결 (serve 호출시 사용)
+        self.server = None
+        self.writer = None
+
+        self.commands = []
+        self.resets = []
+
+        mqtt_client.wallpad = self
+
+    def start(self):
+        self.loop.call_soon(self.poll)
+
+    def poll(self):
+        if not self.silent:
+            for room in self.lights:
+                self.send(self.frame(room, self.LIGHT['state']['cmd']))
+
+        self.loop.call_later(self.poll_interval, self.poll)
+
+    def frame(self, room, cmd):
+        data = '00' + ''.join('{:02X}'.format(state) for state in self.lights[room])
+        return checksum('F7' + self.LIGHT['state']['id'] + '1' + str(room) + cmd + '{:02X}'.format(len(data) // 2) + data + '0000')
+
+    def send(self, packet):
+        if self.paths['mqtt']:
+            self.mqtt.deliver(EW11_TOPIC + '/recv', bytes.fromhex(packet))
+        if self.paths['socket'] and self.writer is not None:
+            self.writer.write(bytes.fromhex(packet))
+
+    # EW11 socket 서버 시작 (localhost의 임의 port 반환)
+    async def serve(self):
+        self.server = await asyncio.start_server(self.accept, '127.0.0.1', 0)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def accept(self, reader, writer):
+        self.writer = writer
+        try:
+            while True:
+                data = await reader.read(1024)
+                if not data:
+                    break
+                self.receive(data, 'socket')
+        except asyncio.CancelledError:
+            pass
+
+    # 경로 송신 중단 (socket은 연결도 종료)
+    def drop_path(self, path):
+        self.paths[path] = False
+
+        if path == 'socket':
+            self.server.close()
+            if self.writer is not None:
+                self.writer.close()
+                self.writer = None
+
+    # EW11으로 전송된 명령 처리 (여러 패킷이 이어 붙은 경우 포함)
+    def receive(self, payload, path='mqtt'):
+        packets = payload.hex().upper()
+
+        while packets.startswith('F7'):
+            length = 14 + int(packets[8:10], 16) * 2
+            packet, packets = packets[:length], packets[length:]
+            self.commands.append((self.loop.time(), path, packet))
+
+            if self.ignore_commands or self.silent:
+                continue
+
+            if packet[2:4] == self.LIGHT['power']['id'] and packet[6:8] == self.LIGHT['power']['cmd']:
+                room = int(packet[5], 16)
+                self.lights[room][int(packet[11], 16) - 1] = int(packet[12:14], 16)
+                if not self.drop_acks:
+                    self.loop.call_later(self.ack_delay, self.send, self.frame(room, self.LIGHT['power']['ack']))
+            # 상태 요구 패킷은 다음 Polling을 기다리지 않고 바로 State 회신
+            elif packet[2:4] == self.LIGHT['query']['id'] and packet[6:8] == self.LIGHT['query']['cmd']:
+                room = int(packet[5], 16)
+                self.loop.call_later(self.ack_delay, self.send, self.frame(room, self.LIGHT['state']['cmd']))
+
+    # Telnet 리셋 후 응답 재개
+    def restart(self):
+        self.resets.append(self.loop.time())
+        self.silent = False
+
+
+# EW11Telnet 대신 사용하는 가짜 Telnet (Restart 명령을 받으면 월패드 재시작)
+class FakeTelnet:
+    def __init__(self, wallpad):
+        self.wallpad = wallpad
+
+    async def connect(self):
+        pass
+
+    async def read_until(self, expected):
+        return expected
+
+    async def write(self, data):
+        if data.strip() == b'Restart':
+            self.wallpad.restart()
+
+    def close(self):
+        pass
+
+
+# 시나리오 실행 환경
+class Harness:
+    def __init__(self, options=None, rooms={1: 3}, poll_interval=0.2):
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.json')) as file:
+            self.config = json.load(file)['options']
+
+        # 파일 저장 및 Reboot 대기 없이 MQTT 모드로 실행
+        self.config.update({'mode': 'mqtt', 'history_store': False, 'snapshot_store': False, 'reboot_control': False, 'random_backoff': False})
+        self.config.update(options or {})
+
+        self.loop = VirtualClockLoop()
+        self.mqtt = FakeMQTT(self.loop)
+        self.wallpad = FakeWallpad(self.mqtt, self.loop, rooms, poll_interval)
+
+        # socket을 사용하는 모드는 localhost에 EW11 socket 서버 실행
+        if self.config['mode'] != 'mqtt':
+            self.config['ew11_server'] = '127.0.0.1'
+            self.config['ew11_port'] = self.loop.run_until_complete(self.wallpad.serve())
+
+        # ezville 로그는 가상 시간과 함께 보관
+        self.logs = []
+        self.elapsed = None
+
+    # 가상 시간 when초에 실행
+    def at(self, when, callback, *args):
+        self.loop.call_at(when, callback, *args)
+
+    def command(self, when, device, state, value):
+        self.at(when, self.mqtt.deliver, 'ezville/{}/{}/command'.format(device, state), value)
+
+    # duration초 (가상 시간) 동안 ezville_loop 실행 (실제 소요 시간은 elapsed에 기록)
+    def run(self, duration):
+        asyncio.set_event_loop(self.loop)
+        random.seed(0)
+
+        log = ezville.log
+        ezville.log = lambda string: self.logs.append((self.loop.time(), string))
+
+        self.wallpad.start()
+        self.loop.call_at(duration, self.loop.stop)
+
+        start = time.perf_counter()
+        try:
+            ezville.ezville_loop(self.config, clock=self.loop.clock, mqtt_client=self.mqtt, telnet=lambda host, timeout: FakeTelnet(self.wallpad), loop=self.loop)
+        finally:
+            self.elapsed = time.perf_counter() - start
+
+            for task in asyncio.all_tasks(self.loop):
+                task.cancel()
+            self.loop.run_until_complete(asyncio.gather(*asyncio.all_tasks(self.loop), return_exceptions=True))
+            self.loop.close()
+            asyncio.set_event_loop(None)
+            ezville.log = log
+
+
+# 월패드가 명령에 응답하지 않으면 command_retry_count만큼 재전송 후 포기
+def scenario_retry_exhaustion():
+    harness = Harness({'command_retry_count': 30, 'command_interval': 0.5, 'command_deadline_interactive': 60})
+    harness.wallpad.ignore_commands = True
+    harness.command(1.0, 'light_01_01', 'power', 'ON')
+
+    harness.run(60)
+
+    sends = harness.mqtt.history(EW11_SEND_TOPIC)
+    assert len(sends) == 30, len(sends)
+    assert harness.wallpad.lights[1][0] == 0
+
+    return harness, '재전송 {}회, 마지막 전송 {:.1f}초'.format(len(sends), sends[-1][0])
+
+
+# 재시도 중인 automation 명령보다 나중에 들어온 interactive 방 단위 명령 (대기전력)을 먼저 실행
+def scenario_priority_preempt():
+    harness = Harness({'command_retry_count': 60, 'command_deadline_automation': 60})
+    harness.wallpad.ignore_commands = True
+    harness.at(1.0, harness.mqtt.deliver, 'ezville/light_01_01/power/automation/command', 'ON')
+    harness.command(2.0, 'plug_01_01', 'power', 'ON')
+
+    harness.run(15)
+
+    plug = [timestamp for timestamp, payload in harness.mqtt.history(EW11_SEND_TOPIC) if payload[1] == int(RS485_DEVICE['plug']['power']['id'], 16)]
+    assert plug and plug[0] < 3.0, plug
+
+    return harness, '대기전력 명령 첫 전송 {:.2f}초'.format(plug[0])
+
+
+# 월패드가 바로 응답하면 한번만 전송하고 State 업데이트
+def scenario_command_ack():
+    harness = Harness()
+    harness.command(1.0, 'light_01_02', 'power', 'ON')
+
+    harness.run(5)
+
+    sends = harness.mqtt.history(EW11_SEND_TOPIC)
+    states = harness.mqtt.history(STATE_TOPIC.format('light_01_02', 'power'))
+    assert len(sends) == 1, len(sends)
+    assert states[-1][1] == b'ON', states
+
+    return harness, 'ON 반영 {:.2f}초'.format(states[-1][0] - 1.0)
+
+
+# optimistic_mode에서 묶음 명령이 이미 Bus State와 같은 목표값으로 바뀌어도 확인 대기가 남지 않고 이후 변경을 반영
+def scenario_optimistic_merge():
+    harness = Harness({'optimistic_mode': True})
+    harness.command(1.0, 'light_01_01', 'power', 'ON')
+    harness.command(1.01, 'light_01_01', 'power', 'OFF')
+    harness.at(5.0, harness.wallpad.lights[1].__setitem__, 0, 1)
+
+    harness.run(8)
+
+    states = harness.mqtt.history(STATE_TOPIC.format('light_01_01', 'power'))
+    assert states[-1][1] == b'ON' and states[-1][0] >= 5.0, states
+
+    return harness, '벽 스위치 변경 반영 {:.2f}초'.format(states[-1][0])
+
+
+# 묶음 시간 안에 같은 조명에 ON, OFF가 이어서 들어오면 (Bus State와 같은 OFF라도) 마지막 OFF 명령으로 대체
+def scenario_batch_replace():
+    harness = Harness()
+    harness.command(1.0, 'light_01_02', 'power', 'ON')
+    harness.command(1.02, 'light_01_02', 'power', 'OFF')
+
+    harness.run(5)
+
+    states = harness.mqtt.history(STATE_TOPIC.format('light_01_02', 'power'))
+    assert harness.wallpad.lights[1][1] == 0, harness.wallpad.lights[1]
+    assert all(payload == b'OFF' for timestamp, payload in states), states
+
+    return harness, '마지막 명령 OFF 유지, 전송 {}회'.format(len(harness.mqtt.history(EW11_SEND_TOPIC)))
+
+
+# ACK가 없고 Polling이 느려도 state_query를 사용하면 상태 요구 패킷으로 바로 확인
+def scenario_state_query():
+    results = {}
+
+    for state_query in (False, True):
+        harness = Harness({'state_query': state_query, 'state_query_delay': 0.2, 'state_query_interval': 1.0}, poll_interval=5.0)
+        harness.wallpad.drop_acks = True
+        harness.command(1.0, 'light_01_01', 'power', 'ON')
+
+        harness.run(10)
+
+        states = [timestamp for timestamp, payload in harness.mqtt.history(STATE_TOPIC.format('light_01_01', 'power')) if payload == b'ON']
+        queries = [packet for timestamp, path, packet in harness.wallpad.commands if packet[6:8] == RS485_DEVICE['light']['query']['cmd']]
+        results[state_query] = (states[0] - 1.0, len(queries))
+
+    assert results[False][1] == 0, results
+    assert results[True][0] < 1.0 <= results[False][0], results
+    assert results[True][1] == 1, results
+
+    return harness, 'ON 반영 {:.2f}초 (state_query 미사용시 {:.2f}초), 상태 요구 {}회'.format(results[True][0], results[False][0], results[True][1])
+
+
+# failover 모드에서 socket이 끊기면 failover_timeout초 안에 MQTT로 전송 경로 전환
+def scenario_failover():
+    harness = Harness({'mode': 'failover', 'failover_timeout': 3})
+    harness.command(5.0, 'light_01_01', 'power', 'ON')
+    harness.at(20, harness.wallpad.drop_path, 'socket')
+    harness.command(30.0, 'light_01_02', 'power', 'ON')
+
+    harness.run(40)
+
+    paths = [path for timestamp, path, packet in harness.wallpad.commands]
+    switches = harness.mqtt.history('ezville/bridge_01_01/activePath/state')
+    assert paths == ['socket', 'mqtt'], paths
+    assert [payload for timestamp, payload in switches] == [b'socket', b'mqtt'], switches
+    assert 20 < switches[-1][0] <= 24, switches
+    assert harness.wallpad.lights[1][:2] == [1, 1]
+
+    return harness, 'MQTT 전환 {:.1f}초 후'.format(switches[-1][0] - 20)
+
+
+# force_update_period마다 force_update_duration초 동안 변화가 없어도 State 재전송
+def scenario_force_update():
+    harness = Harness({'force_update_period': 600, 'force_update_duration': 2}, poll_interval=1.0)
+
+    harness.run(1300)
+
+    states = harness.mqtt.history(STATE_TOPIC.format('light_01_01', 'power'))
+    windows = sorted({int(timestamp // 600) for timestamp, payload in states[1:]})
+    assert windows == [1, 2], windows
+
+    return harness, 'State 재전송 {}회 (강제 업데이트 구간 {})'.format(len(states) - 1, windows)
+
+
+# reboot_control 사용 시 MQTT Integration이 늦게 온라인이 되어도 그동안 받은 State로 바로 장치 등록
+def scenario_startup():
+    harness = Harness({'reboot_control': True}, poll_interval=30.0)
+    harness.at(5.0, harness.mqtt.deliver, 'homeassistant/status', 'online', True)
+
+    harness.run(10)
+
+    states = harness.mqtt.history(STATE_TOPIC.format('light_01_01', 'power'))
+    online = harness.mqtt.history(AVAILABILITY_TOPIC)
+    phases = [string for timestamp, string in harness.logs if '시작 단계 완료' in string]
+    assert states and 5.0 <= states[0][0] < 6.0, states
+    assert [payload for timestamp, payload in online] == ['online'], online
+    assert len(phases) == 4, phases
+
+    return harness, 'State {:.2f}초, online {:.2f}초 (다음 Polling 30초)'.format(states[0][0], online[0][0])
+
+
+# MQTT Broker가 ew11_timeout초보다 오래 재시작되어도 EW11은 리셋하지 않음
+def scenario_broker_restart():
+    harness = Harness({'ew11_timeout': 30, 'ew11_health_check_delay': 5})
+    harness.at(10, harness.mqtt.drop_connection, 120)
+
+    harness.run(200)
+
+    assert harness.wallpad.resets == [], harness.wallpad.resets
+
+    return harness, 'MQTT 120초 연결 해제 중 EW11 리셋 없음'
+
+
+# ew11_timeout초 동안 수신이 없으면 Telnet으로 EW11 리셋
+def scenario_health_reset():
+    harness = Harness({'ew11_timeout': 3600, 'ew11_health_check_delay': 5})
+    harness.at(10, setattr, harness.wallpad, 'silent', True)
+
+    harness.run(4000)
+
+    resets = harness.wallpad.resets
+    assert len(resets) == 1, resets
+    assert 3610 <= resets[0] <= 3620, resets
+
+    return harness, '리셋 {:.0f}초'.format(resets[0])
+
+
+SCENARIOS = {
+    'retry_exhaustion': scenario_retry_exhaustion,
+    'command_ack': scenario_command_ack,
+    'priority_preempt': scenario_priority_preempt,
+    'optimistic_merge': scenario_optimistic_merge,
+    'batch_replace': scenario_batch_replace,
+    'state_query': scenario_state_query,
+    'failover': scenario_failover,
+    'force_update': scenario_force_update,
+    'startup': scenario_startup,
+    'broker_restart': scenario_broker_restart,
+    'health_reset': scenario_health_reset,
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='ezville_loop 가상 시간 시나리오 실행')
+    parser.add_argument('scenarios', nargs='*', help='실행할 시나리오 (지정하지 않으면 전체): ' + ', '.join(SCENARIOS))
+    parser.add_argument('--verbose', action='store_true', help='ezville 로그를 가상 시간과 함께 출력')
+    args = parser.parse_args(argv)
+
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error('알 수 없는 시나리오: {}'.format(name))
+
+    failed = 0
+    for name in args.scenarios or SCENARIOS:
+        try:
+            harness, result = SCENARIOS[name]()
+            print('[PASS] {} ({:.0f} ms): {}'.format(name, harness.elapsed * 1000, result))
+        except AssertionError as e:
+            failed += 1
+            harness = None
+            print('[FAIL] {}: {}'.format(name, e))
+
+        if args.verbose and harness is not None:
+            for timestamp, string in harness.logs:
+                print('  {:>10.3f} {}'.format(timestamp, string))
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())